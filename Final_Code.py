@@ -1,11 +1,1159 @@
-from graphics import GraphWin, Rectangle, Text, Point, Image
-import pandas as pd
+import argparse
+import atexit
+import base64
+import contextlib
+import functools
+import io
+import itertools
+import json
+import mmap
+import operator
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
 
-# Load dataset once at the beginning
-DATASET = pd.read_csv('clean_covid_data.csv')
+# pandas, matplotlib and graphics are slow to import, so they are only imported once they are needed
+
+DATASET_PATH = 'clean_covid_data.csv'
+VARIABLES = ["DIABETES", "RENAL_CHRONIC", "ASTHMA", "CARDIOVASCULAR"]
+# Yes/no flags of the dataset, in the bit order of the CONDITIONS bitmask column
+CONDITION_FLAGS = VARIABLES + ["COPD", "INMSUPR", "HIPERTENSION", "OTHER_DISEASE", "OBESITY", "TOBACCO",
+                               "PNEUMONIA", "INTUBED", "ICU", "PREGNANT"]
+
+AGE_GROUPS = ["Children", "Young Adults", "Adults", "Older Adults", "Elderly"]
+AGE_GROUP_EDGES = [12, 24, 64, 74]  # Upper (inclusive) age of every group but the last
+
+# CSV columns that generate_bar_plot, generate_histogram and generate_pie_chart are built from
+CHART_COLUMNS = ["AGE", "DATE_DIED"] + VARIABLES
+# The other CSV columns condition queries can select patients by; each is only loaded (and
+# added to the cache) the first time a query uses it, so cold starts still parse just CHART_COLUMNS
+QUERY_COLUMNS = ["USMER", "MEDICAL_UNIT", "SEX", "PATIENT_TYPE", "INTUBED", "PNEUMONIA", "PREGNANT", "COPD",
+                 "INMSUPR", "HIPERTENSION", "OTHER_DISEASE", "OBESITY", "TOBACCO", "CLASIFFICATION_FINAL", "ICU"]
+# Columns computed from the CSV columns when the cache is built
+DERIVED_COLUMNS = ["AGE_GROUP", "DIED", "DEATH_DAY", "DEATH_MONTH", "CONDITIONS"]
+# CSV columns that are only kept through the columns derived from them
+REPLACED_COLUMNS = ["DATE_DIED"]
+# CSV columns with missing values, stored as this unsigned type with its largest value meaning missing
+NULLABLE_COLUMNS = {"AGE": np.uint8}
+
+DATE_DIED_FORMAT = '%d/%m/%Y'
+NO_DEATH_DAY = -1  # DEATH_DAY of survivors and of unparseable dates
+NO_MONTH = 0  # DEATH_MONTH of survivors and of unparseable dates
+
+# Bump whenever the layout of the binary cache changes so old caches are rebuilt
+CACHE_VERSION = 5
+
+# Setting COVID_TRACKER_STREAM=1 folds the CSV into the chart counts chunk by chunk instead of loading it
+STREAM = os.environ.get("COVID_TRACKER_STREAM", "") not in ("", "0")
+STREAM_CHUNK_ROWS = 250_000
+# Compact dtypes the chart columns are parsed into; the flags are float so a blank cell reads as missing
+# rather than failing the parse, and compact_column turns them back into int8 when none is blank
+STREAM_DTYPES = dict({var: np.float32 for var in VARIABLES}, AGE=np.float32, DATE_DIED=str)
+
+# Setting COVID_TRACKER_TRACE=trace.json records every page transition and chart phase to that file
+TRACE_PATH = os.environ.get("COVID_TRACKER_TRACE") or None
+
+
+# Instrumentation
+_TRACE_EVENTS = []
+_NOT_TRACED = contextlib.nullcontext()
+
+
+def trace_phase(name, **args):
+    """Context manager timing one phase when tracing is on; a shared no-op otherwise."""
+    if TRACE_PATH is None:
+        return _NOT_TRACED
+    return _traced_phase(name, args)
+
+
+@contextlib.contextmanager
+def _traced_phase(name, args):
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        memory = tracemalloc.get_traced_memory()[0]
+        # A Chrome trace-event "complete" event, loadable in chrome://tracing or Perfetto
+        _TRACE_EVENTS.append({
+            "name": name, "ph": "X", "ts": start / 1000, "dur": (end - start) / 1000,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "args": dict(args, allocated_bytes=memory - start_memory, traced_bytes=memory),
+        })
+
+
+def write_trace(path=None):
+    """Dumps the recorded phases as a Chrome trace-event JSON file."""
+    with open(path or TRACE_PATH, 'w') as f:
+        json.dump({"traceEvents": list(_TRACE_EVENTS), "displayTimeUnit": "ms"}, f)
+
+
+if TRACE_PATH is not None:
+    tracemalloc.start()
+    atexit.register(write_trace)
+
+
+# Age groups
+def age_group_labels(age_edges):
+    """Names the groups produced by a list of upper age edges, e.g. [12, 24] -> 0-12, 13-24, 25+."""
+    if list(age_edges) == AGE_GROUP_EDGES:
+        return AGE_GROUPS
+    lower_bounds = [0] + [edge + 1 for edge in age_edges]
+    labels = [f"{low}-{high}" for low, high in zip(lower_bounds, age_edges)]
+    return labels + [f"{lower_bounds[-1]}+"]
+
+
+def cut_age_groups(ages, age_edges=AGE_GROUP_EDGES):
+    """Buckets ages into a categorical column; each group includes its upper edge."""
+    import pandas as pd
+
+    bins = [-np.inf] + list(age_edges) + [np.inf]
+    return pd.cut(ages, bins=bins, labels=age_group_labels(age_edges))
+
+
+# Binary dataset cache
+def cache_dir_for(csv_path):
+    """Returns the directory holding the binary column cache of a CSV file."""
+    return csv_path + '.cache'
+
+
+def csv_signature(csv_path):
+    """Identifies the CSV contents the cache was built from.
+
+    "end" is where the complete lines stop: a last line still being written is
+    left out of the dataset until an append check finds it finished. The loaders
+    and counters taking a signature (by default, the CSV's current one) read only
+    the complete lines before its end.
+    """
+    stat = os.stat(csv_path)
+    return {"version": CACHE_VERSION, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size,
+            "end": complete_lines_end(csv_path, stat.st_size)}
+
+
+def complete_lines_end(csv_path, size):
+    """Byte offset just past the last line break within the first size bytes of the CSV (0 if there is none)."""
+    with open(csv_path, 'rb') as f:
+        while size > 0:
+            start = max(0, size - 64 * 1024)
+            f.seek(start)
+            newline = f.read(size - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            size = start
+    return 0
+
+
+@contextlib.contextmanager
+def csv_lines(csv_path, end):
+    """The CSV bytes before offset end as a file object, mapped so they are neither copied nor read past."""
+    if end == 0:
+        yield io.BytesIO(b'')  # Not even a header yet (a map of length 0 would cover the whole file)
+        return
+    with open(csv_path, 'rb') as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as lines:
+        yield lines
+
+
+def read_csv_lines(csv_path, end, **read_csv_kwargs):
+    """Parses the CSV lines before byte offset end with pd.read_csv, ignoring anything written after them."""
+    import pandas as pd
+
+    with csv_lines(csv_path, end) as lines:
+        return pd.read_csv(lines, **read_csv_kwargs)
+
+
+def missing_code(dtype):
+    """The value that stands for missing in a NULLABLE_COLUMNS array."""
+    return np.iinfo(dtype).max
+
+
+def compact_column(series, nullable_dtype=None):
+    """Converts a parsed CSV column to the smallest numpy array that holds it.
+
+    Columns given a nullable_dtype always get that type, with missing values stored as missing_code.
+    """
+    import pandas as pd
+
+    if nullable_dtype is not None:
+        values = series.dropna()
+        if len(values) and (values.min() < 0 or values.max() >= missing_code(nullable_dtype)
+                            or (values != values.round()).any()):
+            raise ValueError(f"{series.name} has values that do not fit in {np.dtype(nullable_dtype).name}")
+        return series.fillna(missing_code(nullable_dtype)).to_numpy(dtype=nullable_dtype)
+    if series.isna().any():
+        return series.to_numpy(dtype=np.float32)
+    return pd.to_numeric(series, downcast='integer').to_numpy()
+
+
+def replace_file(path, write):
+    """Writes a file through write(f) on a temporary file, then swaps it in at path.
+
+    Another process memory-mapping the old file keeps its inode, so it never sees a half-written file.
+    """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+def write_cache(cache_dir, signature, arrays):
+    """Stores one .npy file per column plus a meta.json describing them, written last."""
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)  # An interrupted rebuild must not look like a valid cache
+    for column, values in arrays.items():
+        replace_file(os.path.join(cache_dir, f'{column}.npy'), lambda f: np.save(f, values))
+    meta = dict(signature, columns=list(arrays))
+    replace_file(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+
+
+def read_cache(cache_dir, signature, columns):
+    """Memory-maps the cached columns, or returns None if the cache is missing or stale."""
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(meta.get(key) != value for key, value in signature.items()):
+        return None
+    if not set(columns) <= set(meta['columns']):
+        return None
+    return {column: np.load(os.path.join(cache_dir, f'{column}.npy'), mmap_mode='r') for column in columns}
+
+
+def parse_death_dates(date_died):
+    """Splits DATE_DIED into a died flag, the death date as days since 1970-01-01, and its month."""
+    import pandas as pd
+
+    dates = pd.to_datetime(date_died, format=DATE_DIED_FORMAT, errors='coerce')
+    parsed = dates.notna().to_numpy()
+    days = np.full(len(dates), NO_DEATH_DAY, dtype=np.int32)
+    days[parsed] = dates[parsed].to_numpy(dtype='datetime64[D]').astype(np.int32)
+    months = dates.dt.month.fillna(NO_MONTH).to_numpy(dtype=np.int8)
+    # A recorded but unreadable date still counts as a death, as it always has
+    return date_died.notna().to_numpy(), days, months
+
+
+def condition_bit(variable):
+    """Returns the CONDITIONS bit of a condition flag."""
+    return 1 << CONDITION_FLAGS.index(variable)
+
+
+def pack_conditions(frame):
+    """Packs the condition flags of each row into one bitmask.
+
+    A flag's bit is set unless it is coded 2 (does not have it), which is exactly
+    the rows filter_dataset keeps. Flags missing from the frame are left unset, so
+    filters on them go through a condition query instead (see split_filters).
+    """
+    conditions = np.zeros(len(frame), dtype=np.uint16)
+    for var in CONDITION_FLAGS:
+        if var in frame:
+            conditions |= np.where(frame[var].to_numpy() != 2, condition_bit(var), 0).astype(np.uint16)
+    return conditions
+
+
+def derive_columns(frame):
+    """Computes the DERIVED_COLUMNS arrays stored in the cache next to the CSV columns."""
+    died, death_days, death_months = parse_death_dates(frame['DATE_DIED'])
+    return {
+        "AGE_GROUP": cut_age_groups(frame['AGE']).cat.codes.to_numpy(dtype=np.int8),
+        "DIED": died,
+        "DEATH_DAY": death_days,
+        "DEATH_MONTH": death_months,
+        "CONDITIONS": pack_conditions(frame),
+    }
+
+
+def prepare_arrays(parsed):
+    """Compacts the parsed CSV columns and adds the DERIVED_COLUMNS computed from them."""
+    arrays = {column: compact_column(parsed[column], NULLABLE_COLUMNS.get(column))
+              for column in parsed if column not in REPLACED_COLUMNS}
+    arrays.update(derive_columns(parsed))
+    return arrays
+
+
+def frame_from_arrays(arrays):
+    """Wraps cached column arrays in a DataFrame without copying the numeric columns."""
+    import pandas as pd
+
+    columns = {}
+    for column, values in arrays.items():
+        if column == 'AGE_GROUP':
+            # The codes come from cut_age_groups, so skip validation and keep using the same array
+            values = pd.Categorical.from_codes(values, categories=AGE_GROUPS, validate=False)
+        elif column in NULLABLE_COLUMNS:
+            # A nullable integer column over the same array, so missing values still read as missing
+            values = pd.arrays.IntegerArray(values, values == missing_code(values.dtype))
+        columns[column] = values
+    return pd.DataFrame(columns, copy=False)
+
+
+def load_dataset(csv_path=DATASET_PATH, columns=CHART_COLUMNS, signature=None):
+    """Loads the chart columns of the dataset, parsing the CSV only when its cache is stale.
+
+    The CSV, up to the end of the signature (see csv_signature), is parsed straight into
+    the STREAM_DTYPES, which keeps the peak memory of a cold start low.
+    """
+    cache_dir = cache_dir_for(csv_path)
+    signature = signature or csv_signature(csv_path)
+    kept_columns = [column for column in columns if column not in REPLACED_COLUMNS]
+    arrays = read_cache(cache_dir, signature, kept_columns + DERIVED_COLUMNS)
+    if arrays is None:
+        dtypes = {column: dtype for column, dtype in STREAM_DTYPES.items() if column in columns}
+        arrays = prepare_arrays(read_csv_lines(csv_path, signature["end"], usecols=columns, dtype=dtypes))
+        try:
+            write_cache(cache_dir, signature, arrays)
+        except OSError:
+            pass  # Read-only location: keep working from the parsed columns
+    dataset = frame_from_arrays(arrays)
+    seed_derived(dataset, "source", {"csv_path": csv_path, "end": signature["end"], "signature": signature})
+    return dataset
+
+
+def add_cache_column(cache_dir, signature, column, values):
+    """Adds one column to a cache that still matches signature, listing it in meta.json last."""
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if any(meta.get(key) != value for key, value in signature.items()):
+            return  # Rebuilt for a newer CSV since this dataset was loaded
+        replace_file(os.path.join(cache_dir, f'{column}.npy'), lambda f: np.save(f, values))
+        meta['columns'] = [name for name in meta['columns'] if name != column] + [column]
+        replace_file(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+    except (OSError, ValueError):
+        pass  # Read-only location or a cache being rebuilt: the column is just parsed again next time
+
+
+def memory_report(csv_path=DATASET_PATH):
+    """Prints the memory each column takes when the whole CSV is read with default dtypes, next to the dataset."""
+    import pandas as pd
+
+    full_frame = pd.read_csv(csv_path)
+    full = full_frame.memory_usage(deep=True, index=False)
+    dataset = load_dataset(csv_path)
+    compact = dataset.memory_usage(deep=True, index=False)
+    print(f"{'Column':<22} {'pd.read_csv':<22} Dataset")
+    for column in list(full.index) + [column for column in compact.index if column not in full.index]:
+        before = f"{full[column] / 1e6:8.2f} MB  {full_frame[column].dtype}" if column in full.index else "-"
+        after = f"{compact[column] / 1e6:8.2f} MB  {dataset[column].dtype}" if column in compact.index else "dropped"
+        print(f"{column:<22} {before:<22} {after}")
+    print(f"{'Total':<22} {full.sum() / 1e6:8.2f} MB{'':<11} {compact.sum() / 1e6:8.2f} MB")
+    print(f"{full.sum() / len(full_frame):.1f} bytes per patient before, {compact.sum() / len(dataset):.1f} after "
+          f"({full.sum() / compact.sum():.1f}x smaller)")
+
+
+# Aggregate cube
+# Every condition flag is reduced to one of three states along its cube axis
+HAS_CONDITION, NO_CONDITION, OTHER_CODE = 0, 1, 2
+# Rows without an age go to the last age slot, rows without a parseable death date to NO_MONTH
+UNKNOWN_AGE_GROUP = len(AGE_GROUPS)
+
+CUBE_SHAPE = (3,) * len(VARIABLES) + (len(AGE_GROUPS) + 1, 13, 2)
+AGE_AXIS, MONTH_AXIS, DIED_AXIS = len(VARIABLES), len(VARIABLES) + 1, len(VARIABLES) + 2
+
+# Structures derived from a dataset (aggregate cube, indexes), built at most once per dataset object
+_DERIVED = {}
+_DERIVED_LOCK = threading.RLock()  # The background warm-up builds them while the GUI may ask for them
+
+
+def derived(dataset, name, build):
+    """Returns build(dataset), computing it only the first time it is asked for this dataset."""
+    key = id(dataset)
+    with _DERIVED_LOCK:
+        entry = _DERIVED.get(key)
+        if entry is None or entry["ref"]() is not dataset:
+            def forget(ref):
+                if key in _DERIVED and _DERIVED[key]["ref"] is ref:
+                    del _DERIVED[key]
+            entry = {"ref": weakref.ref(dataset, forget), "values": {}}
+            _DERIVED[key] = entry
+        if name not in entry["values"]:
+            entry["values"][name] = build(dataset)
+        return entry["values"][name]
+
+
+def seed_derived(dataset, name, value):
+    """Records a derived structure that was computed some other way, e.g. carried over from an older dataset."""
+    derived(dataset, name, lambda _: value)
+
+
+def derived_entry(dataset, name, key, build, entries):
+    """Like derived, for a family of structures built by build() per key, keeping the entries most recently used."""
+    cache = derived(dataset, name, lambda _: OrderedDict())
+    with _DERIVED_LOCK:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = build()  # Outside the lock, so one slow entry does not hold up the others
+    with _DERIVED_LOCK:
+        cache[key] = value
+        if len(cache) > entries:
+            cache.popitem(last=False)
+    return value
+
+
+def condition_states(values):
+    """Maps the raw 1/2/97/98 codes of a condition flag to its cube axis state."""
+    values = np.asarray(values)
+    return np.where(values == 1, HAS_CONDITION, np.where(values == 2, NO_CONDITION, OTHER_CODE))
+
+
+def build_aggregate_cube(dataset):
+    """Counts patients for every combination of condition states, age group, death month and outcome."""
+    with trace_phase("aggregate", rows=len(dataset)):
+        age_groups = dataset['AGE_GROUP'].cat.codes.to_numpy(dtype=np.int64)
+        age_groups[age_groups < 0] = UNKNOWN_AGE_GROUP
+
+        died = dataset['DIED'].to_numpy()
+        months = dataset['DEATH_MONTH'].to_numpy(dtype=np.int64)
+
+        # Flatten every row to a single cell number and count all cells in one pass
+        cell = np.zeros(len(dataset), dtype=np.int64)
+        for var in VARIABLES:
+            cell = cell * 3 + condition_states(dataset[var])
+        cell = (cell * CUBE_SHAPE[AGE_AXIS] + age_groups) * CUBE_SHAPE[MONTH_AXIS] + months
+        cell = cell * 2 + died
+        return np.bincount(cell, minlength=int(np.prod(CUBE_SHAPE))).reshape(CUBE_SHAPE)
+
+
+def stream_aggregate_cube(csv_path=DATASET_PATH, chunk_rows=STREAM_CHUNK_ROWS, signature=None):
+    """Builds the aggregate cube of a CSV that may not fit in memory, one chunk of rows at a time.
+
+    Only the chart columns are parsed, so peak memory depends on chunk_rows, not on the file size.
+    """
+    import pandas as pd
+
+    signature = signature or csv_signature(csv_path)
+    cube = np.zeros(CUBE_SHAPE, dtype=np.int64)
+    with trace_phase("stream aggregate"), csv_lines(csv_path, signature["end"]) as lines, \
+            pd.read_csv(lines, usecols=CHART_COLUMNS, dtype=STREAM_DTYPES, chunksize=chunk_rows) as chunks:
+        for chunk in chunks:
+            cube += build_aggregate_cube(frame_from_arrays(prepare_arrays(chunk)))
+    return cube
+
+
+def get_aggregate_cube(dataset, where=None):
+    """Returns the aggregate cube of a dataset, building it on first use.
+
+    With a condition query (see parse_query) only the patients matching it are
+    counted. A streamed dataset is already just its cube and is returned as is.
+    """
+    where = as_query(where)
+    if isinstance(dataset, np.ndarray):
+        if where is not None:
+            raise ValueError("condition queries need the patient rows, which a streamed dataset does not keep")
+        return dataset
+    if where is None:
+        return derived(dataset, "cube", build_aggregate_cube)
+    return derived_entry(dataset, "query_cubes", where,
+                         lambda: build_aggregate_cube(dataset.loc[query_mask(dataset, where), CUBE_COLUMNS]),
+                         QUERY_CUBE_ENTRIES)
+
+
+# Parallel aggregation: the cube is a sum of counts, so shards of the rows can be counted in separate
+# processes and added up, giving exactly the numbers of build_aggregate_cube
+AGGREGATE_WORKERS = os.cpu_count() or 1  # Processes counting the shards; --workers overrides it
+# A streamed CSV is counted on one process, whose memory does not grow with the core count, unless
+# --workers asks for more (each one then parses a shard of SHARD_BYTES at a time)
+STREAM_WORKERS = 1
+SHARD_ROWS = 2_000_000  # Cached rows counted by one task
+SHARD_BYTES = 32 * 1024 * 1024  # CSV bytes parsed and counted by one task
+CUBE_COLUMNS = VARIABLES + ["AGE_GROUP", "DIED", "DEATH_MONTH"]
+
+
+def aggregate_cache_rows(cache_dir, signature, start, stop):
+    """Counts rows start to stop of a dataset cache into an aggregate cube, reading only those rows."""
+    arrays = read_cache(cache_dir, signature, CUBE_COLUMNS)
+    if arrays is None:
+        raise RuntimeError(f"the cache in {cache_dir} changed while it was being aggregated")
+    return build_aggregate_cube(frame_from_arrays({column: values[start:stop] for column, values in arrays.items()}))
+
+
+def aggregate_csv_range(csv_path, start, stop):
+    """Parses the CSV lines between byte offsets start and stop and counts them into an aggregate cube."""
+    import pandas as pd
+
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        f.seek(start)
+        data = f.read(stop - start)
+    rows = pd.read_csv(io.BytesIO(header + data), usecols=CHART_COLUMNS, dtype=STREAM_DTYPES)
+    return build_aggregate_cube(frame_from_arrays(prepare_arrays(rows)))
+
+
+def csv_byte_ranges(csv_path, shard_bytes=SHARD_BYTES, end=None):
+    """Splits the lines after the CSV header into byte ranges of about shard_bytes that start and end on line breaks.
+
+    The ranges stop at byte offset end, by default the end of the CSV's complete lines.
+    """
+    size = csv_signature(csv_path)["end"] if end is None else end
+    with open(csv_path, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        while bounds[-1] < size:
+            f.seek(bounds[-1] + shard_bytes)
+            f.readline()  # Finish the line the cut fell in, so every line is in exactly one range
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds, bounds[1:]))
+
+
+def cache_shard_tasks(csv_path, shard_rows=SHARD_ROWS, signature=None):
+    """Splits a valid dataset cache into row ranges as (function, args) tasks, or returns None without one."""
+    cache_dir, signature = cache_dir_for(csv_path), signature or csv_signature(csv_path)
+    arrays = read_cache(cache_dir, signature, CUBE_COLUMNS)
+    if arrays is None:
+        return None
+    rows = len(arrays["DIED"])
+    return [(aggregate_cache_rows, (cache_dir, signature, start, min(start + shard_rows, rows)))
+            for start in range(0, rows, shard_rows)]
+
+
+def run_shard_tasks(tasks, workers=None):
+    """Runs aggregation tasks on up to workers processes and adds up their cubes."""
+    workers = min(workers or AGGREGATE_WORKERS, len(tasks))
+    cube = np.zeros(CUBE_SHAPE, dtype=np.int64)
+    with trace_phase("parallel aggregate", shards=len(tasks), workers=workers):
+        if workers <= 1:
+            for function, args in tasks:
+                cube += function(*args)
+            return cube
+        # Spawned rather than forked workers, since the GUI and warm-up threads may be running
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            for partial in [pool.submit(function, *args) for function, args in tasks]:
+                cube += partial.result()
+    return cube
+
+
+def parallel_aggregate_cube(csv_path=DATASET_PATH, workers=None, use_cache=True, signature=None):
+    """Builds the aggregate cube of a CSV on several processes.
+
+    Row ranges of its cache are counted when the cache is valid (and use_cache is set),
+    byte ranges of the CSV itself otherwise, so memory stays bounded by the shard size either way.
+    """
+    signature = signature or csv_signature(csv_path)
+    tasks = cache_shard_tasks(csv_path, signature=signature) if use_cache else None
+    if tasks is None:
+        tasks = [(aggregate_csv_range, (csv_path, start, stop))
+                 for start, stop in csv_byte_ranges(csv_path, end=signature["end"])]
+    return run_shard_tasks(tasks, workers)
+
+
+def cube_bar_counts(cube, variable):
+    """Survivors and deaths per age group among patients with the given condition."""
+    counts = np.take(cube, HAS_CONDITION, axis=VARIABLES.index(variable))
+    counts = counts.sum(axis=tuple(range(len(VARIABLES) - 1)) + (MONTH_AXIS - 1,))
+    return counts[:len(AGE_GROUPS), 0], counts[:len(AGE_GROUPS), 1]
+
+
+def cube_pie_counts(cube, variable):
+    """Deaths and survivors split by whether they had (1) or did not have (2) the condition."""
+    import pandas as pd
+
+    axis = VARIABLES.index(variable)
+    counts = np.moveaxis(cube, axis, 0)[[HAS_CONDITION, NO_CONDITION]]
+    counts = counts.reshape(2, -1, 2).sum(axis=1)
+    dead_counts = pd.Series(counts[:, 1], index=[1, 2])
+    alive_counts = pd.Series(counts[:, 0], index=[1, 2])
+    return dead_counts, alive_counts
+
+
+def cube_month_counts(cube, filters):
+    """Deaths per month (January first) among patients passing filter_dataset(filters)."""
+    counts = cube
+    for var in filters:
+        # filter_dataset keeps every code except 2, so drop only the NO_CONDITION state
+        counts = np.take(counts, [HAS_CONDITION, OTHER_CODE], axis=VARIABLES.index(var))
+    counts = counts.sum(axis=tuple(range(len(VARIABLES))) + (AGE_AXIS,))
+    return counts[1:, 1]
+
+
+def age_group_outcomes(dataset, variable, age_edges=None, where=None):
+    """Survivors and deaths per age group among patients with the variable (and matching where, if given).
+
+    The default groups are read from the aggregate cube; custom age_edges are
+    counted with a single grouped reduction over the dataset.
+    """
+    if age_edges is None or list(age_edges) == AGE_GROUP_EDGES:
+        survived, died = cube_bar_counts(get_aggregate_cube(dataset, where), variable)
+        return AGE_GROUPS, survived, died
+    if isinstance(dataset, np.ndarray):
+        raise ValueError("custom age groups need the patient rows, which a streamed dataset does not keep")
+    where = as_query(where)
+    if where is not None:
+        dataset = dataset[query_mask(dataset, where)]
+
+    age_groups = cut_age_groups(dataset['AGE'], age_edges)
+    # Deaths of patients without the variable become NaN and are skipped by count and sum
+    deaths = dataset['DIED'].where(dataset[variable] == 1)
+    counts = deaths.groupby(age_groups, observed=False).agg(['count', 'sum'])
+    died = counts['sum'].to_numpy(dtype=np.int64)
+    return list(counts.index), counts['count'].to_numpy(dtype=np.int64) - died, died
+
+
+# Incremental appends
+def read_appended_rows(csv_path, offset, columns=CHART_COLUMNS):
+    """Parses the complete lines written to the CSV after byte offset; returns (rows or None, new offset).
+
+    Malformed lines (another number of fields than the header, values that do not parse) are
+    reported and skipped, so they can neither shift the fields of the rows next to them nor
+    hold up the lines after them.
+    """
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1  # A line still being written is left for the next check
+    if end == 0:
+        return None, offset
+    lines = [line for line in data[:end].splitlines(keepends=True) if line.strip()]
+    fields = header.count(b',')  # The dataset never quotes a field, so every comma separates two
+    well_formed = [line for line in lines if line.count(b',') == fields]
+    rows, parsed = parse_appended_lines(header, well_formed, columns)
+    if parsed < len(lines):
+        print(f"Skipped {len(lines) - parsed} malformed lines appended to {csv_path} after byte {offset}",
+              file=sys.stderr)
+    return (rows if parsed else None), offset + end
+
+
+def parse_appended_lines(header, lines, columns):
+    """Parses CSV lines into the STREAM_DTYPES, leaving out any line that does not parse; returns (rows, lines kept)."""
+    import pandas as pd
+
+    dtypes = {column: dtype for column, dtype in STREAM_DTYPES.items() if column in columns}
+
+    def parse(kept):
+        return pd.read_csv(io.BytesIO(header + b''.join(kept)), usecols=columns, index_col=False, dtype=dtypes)
+    try:
+        return parse(lines), len(lines)
+    except ValueError:
+        # Find the bad lines one by one, which is only worth it now that there are some
+        kept = []
+        for line in lines:
+            with contextlib.suppress(ValueError):
+                parse([line])
+                kept.append(line)
+        return parse(kept), len(kept)
+
+
+def column_buffers(dataset):
+    """The raw arrays behind each column of a dataset, which appends write after.
+
+    Nullable columns are turned back into their missing_code arrays, the only copy made.
+    """
+    buffers = {}
+    for column in dataset.columns:
+        if column == 'AGE_GROUP':
+            buffers[column] = dataset[column].array.codes
+        elif column in NULLABLE_COLUMNS:
+            dtype = NULLABLE_COLUMNS[column]
+            buffers[column] = dataset[column].to_numpy(dtype=dtype, na_value=missing_code(dtype))
+        else:
+            buffers[column] = dataset[column].to_numpy()
+    return buffers
+
+
+def grow_column(buffer, length, new_values):
+    """Writes new_values after the first length entries of buffer, reallocating with spare room when needed.
+
+    Doubling the capacity keeps the amortized cost of an append proportional to the new rows.
+    """
+    dtype = np.result_type(buffer.dtype, new_values.dtype)
+    needed = length + len(new_values)
+    if dtype != buffer.dtype or needed > len(buffer) or not buffer.flags.writeable:
+        grown = np.empty(max(needed, 2 * length), dtype=dtype)
+        grown[:length] = buffer[:length]
+        buffer = grown
+    buffer[length:needed] = new_values
+    return buffer
+
+
+def append_rows(dataset, rows):
+    """Returns a new dataset with the parsed CSV rows appended.
+
+    The aggregate cube is carried over by adding the cube of the new rows, and
+    the columns grow in place, so the work depends on the number of new rows.
+    Query columns already loaded into the dataset grow with them when rows has them,
+    and so do the comparison bitsets and query cubes built from them.
+    """
+    with _DERIVED_LOCK:
+        query_buffers = {column: buffer for column, buffer in loaded_query_columns(dataset).items() if column in rows}
+    query_values = {column: compact_column(rows[column]) for column in query_buffers}
+    new_arrays = prepare_arrays(rows.drop(columns=list(query_buffers)))
+    new_frame = frame_from_arrays(new_arrays)
+    new_cube = build_aggregate_cube(new_frame)
+    if isinstance(dataset, np.ndarray):
+        return dataset + new_cube  # A streamed dataset is only its cube
+
+    length = len(dataset)
+    buffers = derived(dataset, "column_buffers", column_buffers)
+    buffers = {column: grow_column(buffers[column], length, new_arrays[column]) for column in buffers}
+    appended = frame_from_arrays({column: buffer[:length + len(rows)] for column, buffer in buffers.items()})
+    seed_derived(appended, "column_buffers", buffers)
+    seed_derived(appended, "query_columns", {column: grow_column(buffer, length, query_values[column])
+                                             for column, buffer in query_buffers.items()})
+    seed_derived(appended, "cube", get_aggregate_cube(dataset) + new_cube)
+    seed_derived(appended, "death_index",
+                 merge_death_index(get_death_index(dataset), build_death_index(new_frame, first_row=length)))
+    carry_query_structures(dataset, appended, new_frame.assign(**query_values))
+    return appended
+
+
+# Rendered chart cache
+CHART_CACHE_BYTES = 64 * 1024 * 1024  # Budget for the PNG bytes kept in memory
+
+_CHART_CACHE = OrderedDict()  # Chart key -> PNG bytes, least recently used first
+CHART_CACHE_STATS = {"hits": 0, "misses": 0, "bytes": 0}
+_DATASET_VERSIONS = itertools.count(1)
+
+_RENDERING = {}  # Chart key -> Future of a chart some thread is drawing right now
+_CHART_LOCK = threading.Lock()  # Guards the cache, its stats and _RENDERING
+_PYPLOT_LOCK = threading.Lock()  # pyplot keeps global state, so only one figure is drawn at a time
+
+
+def dataset_version(dataset):
+    """Returns a number that identifies this dataset object in chart cache keys.
+
+    A query server's dataset is identified by its URL and the version and size the server reports,
+    so charts are redrawn once rows are appended to it.
+    """
+    if isinstance(dataset, str):
+        info = run_query(dataset, "info")
+        return dataset, info["version"], info["rows"]
+    return derived(dataset, "version", lambda _: next(_DATASET_VERSIONS))
+
+
+def cached_chart(key, render):
+    """Returns the PNG bytes cached for key, calling render() to produce them on a miss.
+
+    If another thread is already rendering the same chart, waits for its result instead.
+    """
+    with _CHART_LOCK:
+        png = _CHART_CACHE.get(key)
+        if png is not None:
+            _CHART_CACHE.move_to_end(key)
+            CHART_CACHE_STATS["hits"] += 1
+            return png
+        pending = _RENDERING.get(key)
+        if pending is None:
+            CHART_CACHE_STATS["misses"] += 1
+            pending = _RENDERING[key] = Future()
+            rendering = True
+        else:
+            CHART_CACHE_STATS["hits"] += 1
+            rendering = False
+    if not rendering:
+        return pending.result()
+
+    try:
+        with _PYPLOT_LOCK, trace_phase("render", chart=repr(key)):
+            png = render()
+    except BaseException as error:
+        with _CHART_LOCK:
+            del _RENDERING[key]
+        pending.set_exception(error)
+        raise
+
+    with _CHART_LOCK:
+        del _RENDERING[key]
+        _CHART_CACHE[key] = png
+        CHART_CACHE_STATS["bytes"] += len(png)
+        # Evict least recently used charts until the budget is met, always keeping the new one
+        while CHART_CACHE_STATS["bytes"] > CHART_CACHE_BYTES and len(_CHART_CACHE) > 1:
+            _, evicted = _CHART_CACHE.popitem(last=False)
+            CHART_CACHE_STATS["bytes"] -= len(evicted)
+    pending.set_result(png)
+    return png
+
+
+def chart_cache_info():
+    """Hit/miss counts, cached bytes and number of cached charts."""
+    with _CHART_LOCK:
+        return dict(CHART_CACHE_STATS, entries=len(_CHART_CACHE))
+
+
+def import_pyplot():
+    """Imports pyplot the first time a chart is drawn.
+
+    The Agg backend only rasterizes to PNG bytes, which also lets the warm-up thread draw charts.
+    """
+    global plt, mpatches
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
+
+
+# Every chart type draws its figure once; a render only updates the data-dependent artists and rasterizes it.
+# Like every render, templates are only touched while _PYPLOT_LOCK is held.
+_FIGURE_TEMPLATES = {}  # (graph type, layout) -> figure and the artists a render updates
+
+
+def figure_template(key, build):
+    """Returns the figure template for key, calling build() to draw it the first time."""
+    template = _FIGURE_TEMPLATES.get(key)
+    if template is None:
+        with trace_phase("build template", template=repr(key)):
+            template = _FIGURE_TEMPLATES[key] = build()
+        # Keep it out of pyplot's open figures: it is never shown and is reused rather than closed
+        plt.close(template["figure"])
+    return template
+
+
+def figure_png(figure, **savefig_kwargs):
+    """Rasterizes a figure to PNG bytes, leaving it intact for the next render."""
+    buffer = io.BytesIO()
+    with trace_phase("savefig"):
+        figure.savefig(buffer, format='png', **savefig_kwargs)
+    return buffer.getvalue()
+
+
+def query_subtitle(where):
+    """The title line naming the condition query a chart is limited to, or nothing without one."""
+    return "" if where is None else f"\nPatients where {format_query(where)}"
+
+
+def export_png(png, path):
+    """Writes chart PNG bytes to a file."""
+    with open(path, 'wb') as f:
+        f.write(png)
+
+
+def png_image(win, center, png):
+    """Wraps PNG bytes in a graphics Image without going through a file."""
+    import tkinter
+
+    img = Image(center, 1, 1)
+    img.img = tkinter.PhotoImage(master=win, data=base64.b64encode(png), format='png')
+    return img
+
+
+def show_png(win, png, center, elements, export_path=None):
+    """Draws chart PNG bytes centered on the (x, y) window position, optionally also saving them to export_path."""
+    import_graphics()
+    if export_path is not None:
+        export_png(png, export_path)
+    with trace_phase("image draw"):
+        img = png_image(win, Point(*center), png)
+        img.draw(win)
+    elements.append(img)
+
+
+# The dataset is loaded once, on first use
+_DATASET = None
+_DATASET_OFFSET = 0  # Bytes of the CSV already in _DATASET
+_DATASET_LOCK = threading.Lock()
+
+# With --follow, the GUI checks this often for rows appended to the CSV while it waits for clicks
+FOLLOW_APPENDS = False
+APPEND_POLL_SECONDS = 2.0
+
+# With --connect, charts are computed by the query server at this URL instead of a local dataset
+CONNECT_URL = None
+
+
+def load_chart_data(csv_path, signature=None):
+    """Loads a dataset with its aggregate cube counted on every core when it spans several shards.
+
+    When streaming, only the cube is built, chunk by chunk on STREAM_WORKERS processes.
+    """
+    signature = signature or csv_signature(csv_path)
+    if STREAM:
+        if STREAM_WORKERS > 1:
+            return parallel_aggregate_cube(csv_path, STREAM_WORKERS, signature=signature)
+        return stream_aggregate_cube(csv_path, signature=signature)
+    dataset = load_dataset(csv_path, signature=signature)
+    tasks = cache_shard_tasks(csv_path, signature=signature)
+    if tasks is not None and len(tasks) > 1 and AGGREGATE_WORKERS > 1:
+        seed_derived(dataset, "cube", run_shard_tasks(tasks))
+    return dataset
+
+
+def get_dataset():
+    """Returns the dataset, loading it (or streaming it into its cube) the first time it is needed.
+
+    A client of a query server gets the server's URL, which run_query sends the chart queries to.
+    """
+    global _DATASET, _DATASET_OFFSET
+    if CONNECT_URL is not None:
+        return CONNECT_URL
+    with _DATASET_LOCK:
+        if _DATASET is None:
+            with trace_phase("load dataset"):
+                # Rows appended while it loads are past the signature's end, left for ingest_appended_rows
+                signature = csv_signature(DATASET_PATH)
+                _DATASET = load_chart_data(DATASET_PATH, signature)
+                _DATASET_OFFSET = signature["end"]
+        return _DATASET
+
+
+def ingest_appended_rows():
+    """Folds rows appended to the CSV since it was loaded into the dataset; returns how many there were.
+
+    Rows that cannot be read are reported and left unread, to be tried again at the next check.
+    """
+    global _DATASET, _DATASET_OFFSET
+    with _DATASET_LOCK:
+        if _DATASET is None:
+            return 0  # Not loaded yet; the first load will read the whole file anyway
+        try:
+            if os.path.getsize(DATASET_PATH) < _DATASET_OFFSET:
+                # The file was replaced rather than appended to, so start over
+                with trace_phase("load dataset"):
+                    signature = csv_signature(DATASET_PATH)
+                    _DATASET = load_chart_data(DATASET_PATH, signature)
+                    _DATASET_OFFSET = signature["end"]
+                return int(get_aggregate_cube(_DATASET).sum())
+            with trace_phase("ingest appended rows"):
+                with _DERIVED_LOCK:
+                    columns = CHART_COLUMNS + list(loaded_query_columns(_DATASET))
+                rows, offset = read_appended_rows(DATASET_PATH, _DATASET_OFFSET, columns)
+                if rows is None:
+                    return 0
+                _DATASET = append_rows(_DATASET, rows)
+                _DATASET_OFFSET = offset
+                if not isinstance(_DATASET, np.ndarray):
+                    # Query columns not loaded yet are read up to here, as the cache no longer covers every row
+                    seed_derived(_DATASET, "source", {"csv_path": DATASET_PATH, "end": offset, "signature": None})
+            return len(rows)
+        except (OSError, ValueError) as error:
+            # Values that do not fit the cache dtypes (e.g. an AGE over 254) or a file being swapped
+            print(f"Could not read the rows appended to {DATASET_PATH} after byte {_DATASET_OFFSET}: {error}",
+                  file=sys.stderr)
+            return 0
+
+
+def __getattr__(name):
+    # Keeps Final_Code.DATASET working now that nothing is loaded at import time
+    if name == "DATASET":
+        return get_dataset()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def build_indexes(dataset):
+    """Builds the aggregate cube and, for a loaded dataset, the death date index ahead of the first chart."""
+    if isinstance(dataset, str):
+        return  # The query server keeps them
+    get_aggregate_cube(dataset)
+    if not STREAM:
+        get_death_index(dataset)
+
+
+def keeps_patient_rows():
+    """Whether patient rows, with their death dates, are kept for the time series and condition queries.
+
+    A streamed dataset (possibly the query server's) only keeps its cube.
+    """
+    if CONNECT_URL is not None:
+        return run_query(CONNECT_URL, "info")["patient_rows"]
+    return not STREAM  # Known without waiting for the dataset to load
+
+
+# Chart queries: the counts behind each chart as JSON-ready dicts, answered locally or by a query server.
+# The chart queries take an optional condition query, where, limiting them to the patients matching it
+def query_bar(dataset, variable, age_edges=None, where=None):
+    """Survivors and deaths per age group among patients with the variable."""
+    age_groups, survived, died = age_group_outcomes(dataset, variable, age_edges, where)
+    return {"age_groups": [str(group) for group in age_groups], "survived": survived.tolist(), "died": died.tolist()}
+
+
+def query_pie(dataset, variable, where=None):
+    """Deaths and survivors that had (code 1) or did not have (code 2) the variable."""
+    dead_counts, alive_counts = cube_pie_counts(get_aggregate_cube(dataset, where), variable)
+    return {"codes": dead_counts.index.tolist(), "died": dead_counts.tolist(), "survived": alive_counts.tolist()}
+
+
+def query_histogram(dataset, filters=(), where=None):
+    """Deaths per month, January first, among patients passing filter_dataset(filters)."""
+    filters, unpacked = split_filters(dataset, filters)
+    return {"months": cube_month_counts(get_aggregate_cube(dataset, both_queries(where, unpacked)), filters).tolist()}
+
+
+def query_time_series(dataset, filters=(), first_day=None, last_day=None, where=None):
+    """Deaths per day, or per week for long ranges, from first_day to last_day (default: all death dates)."""
+    extent = death_day_extent(dataset)
+    first_day = extent[0] if first_day is None else first_day
+    last_day = extent[1] if last_day is None else last_day
+    bin_days = 1 if last_day - first_day < DAILY_MAX_DAYS else 7
+    return {"first_day": first_day, "last_day": last_day, "bin_days": bin_days,
+            "counts": death_counts(dataset, filters, first_day, last_day, bin_days, where).tolist()}
+
+
+def query_extent(dataset):
+    """First and last recorded death day, as days since 1970-01-01."""
+    first_day, last_day = death_day_extent(dataset)
+    return {"first_day": first_day, "last_day": last_day}
+
+
+def query_info(dataset):
+    """Number of patients, the dataset's version, and whether their rows (death dates, conditions) can be queried."""
+    streamed = isinstance(dataset, np.ndarray)
+    return {"rows": int(dataset.sum()) if streamed else len(dataset), "version": dataset_version(dataset),
+            "patient_rows": not streamed}
+
+
+QUERIES = {"bar": query_bar, "pie": query_pie, "histogram": query_histogram, "time-series": query_time_series,
+           "extent": query_extent, "info": query_info}
+LIST_PARAMS = {"filters": str, "age_edges": int}  # Sent comma-separated
+INT_PARAMS = ["first_day", "last_day"]
+QUERY_PARAMS = ["where"]  # Condition queries, sent as format_query text
+QUERY_TIMEOUT = 30  # Seconds a client waits for the query server
+
+
+def run_query(dataset, name, **params):
+    """Answers a chart query from the dataset, or asks the query server when the dataset is its URL."""
+    if isinstance(dataset, str):
+        return fetch_query(dataset, name, params)
+    return QUERIES[name](dataset, **params)
+
+
+def encode_query_params(params):
+    """Turns query parameters into a URL query string, always the same one for the same parameters."""
+    import urllib.parse
+
+    fields = []
+    for key, value in sorted(params.items()):
+        if key in QUERY_PARAMS and isinstance(value, tuple):
+            value = format_query(value)
+        if value is not None:
+            fields.append((key, ",".join(map(str, value)) if isinstance(value, (list, tuple)) else value))
+    return urllib.parse.urlencode(fields)
+
+
+def decode_query_params(query):
+    """Parses a URL query string made by encode_query_params back into query parameters."""
+    import urllib.parse
+
+    params = {}
+    for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+        if key in LIST_PARAMS:
+            params[key] = [LIST_PARAMS[key](item) for item in value.split(",") if item]
+        elif key in INT_PARAMS:
+            params[key] = int(value)
+        else:
+            params[key] = value
+    return params
+
+
+def fetch_query(url, name, params):
+    """Asks the query server at url to answer a chart query."""
+    import urllib.error
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(f"{url}/{name}?{encode_query_params(params)}", timeout=QUERY_TIMEOUT) as response:
+            return json.load(response)
+    except urllib.error.HTTPError as error:
+        raise ValueError(f"query server: {json.load(error)['error']}") from None
+
+
+# Query service
+SERVE_HOST = "127.0.0.1"  # Only local clients
+QUERY_CACHE_ENTRIES = 4096  # Answers kept by the query server
+
+_QUERY_CACHE = OrderedDict()  # (query, parameters, dataset version) -> JSON bytes, least recently used first
+_QUERY_LOCK = threading.Lock()
+
+
+def answer_query(path):
+    """Answers a GET request path such as /bar?variable=DIABETES; returns the HTTP status and JSON body.
+
+    Answers are cached until the dataset changes.
+    """
+    import urllib.parse
+
+    url = urllib.parse.urlsplit(path)
+    name = url.path.strip("/")
+    if name not in QUERIES:
+        return 404, json.dumps({"error": f"unknown query {name!r}, expected one of {sorted(QUERIES)}"}).encode()
+    try:
+        params = decode_query_params(url.query)
+        dataset = get_dataset()
+        key = (name, encode_query_params(params), dataset_version(dataset))
+        with _QUERY_LOCK:
+            body = _QUERY_CACHE.get(key)
+            if body is not None:
+                _QUERY_CACHE.move_to_end(key)
+                return 200, body
+        body = json.dumps(run_query(dataset, name, **params)).encode()
+    except (ValueError, TypeError) as error:
+        # Unknown variables, malformed numbers and unexpected parameters all end up here
+        return 400, json.dumps({"error": str(error)}).encode()
+    with _QUERY_LOCK:
+        _QUERY_CACHE[key] = body
+        if len(_QUERY_CACHE) > QUERY_CACHE_ENTRIES:
+            _QUERY_CACHE.popitem(last=False)
+    return 200, body
+
+
+def make_query_server(port, host=SERVE_HOST):
+    """Creates an HTTP server that answers chart queries, one thread per connection."""
+    import http.server
+
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Lets clients keep their connection open between queries
+        disable_nagle_algorithm = True  # Headers and body go out in separate writes; don't hold the body back
+
+        def do_GET(self):
+            status, body = answer_query(self.path)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # A line per query would drown the console under load
+
+    return http.server.ThreadingHTTPServer((host, port), QueryHandler)
+
+
+def follow_appends():
+    """Keeps folding rows appended to the CSV into the dataset, for the query server."""
+    while True:
+        time.sleep(APPEND_POLL_SECONDS)
+        ingest_appended_rows()
+
+
+def serve(port, host=SERVE_HOST):
+    """Loads the dataset once and answers chart queries over HTTP until interrupted."""
+    build_indexes(get_dataset())
+    if FOLLOW_APPENDS:
+        threading.Thread(target=follow_appends, name="follow", daemon=True).start()
+    server = make_query_server(port, host)
+    print(f"Answering chart queries on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def import_graphics():
+    """Imports the graphics module, which opens its Tk root window as soon as it is loaded.
+
+    Only the GUI needs it, so the headless modes never touch the display; the functions
+    drawing on a window call it themselves, so they also work without main().
+    """
+    global GraphWin, Rectangle, Text, Point, Image
+    from graphics import GraphWin, Rectangle, Text, Point, Image
 
 
 # Define reusable functions
@@ -34,6 +1182,77 @@ def undraw_elements(elements):
         element.undraw()
 
 
+# Retained scenes: every page is drawn once, tagged, and then only hidden or shown
+HIT_CELL_SIZE = 100  # Side, in pixels, of the grid cells used to look up the clicked button
+UNSELECTED_FILL, SELECTED_FILL = "#4e7997", "#aad4d8"
+
+# Patient groups the variable selection pages can limit the charts to, as (label, condition query);
+# groups chosen in the same row are alternatives (or), and the rows must all hold (and)
+PATIENT_FILTERS = [
+    [("Women", "SEX == 1"), ("Men", "SEX == 2")],
+    [("Under 65", "AGE < 65"), ("65 and over", "AGE >= 65")],
+    [("Outpatients", "PATIENT_TYPE == 1"), ("Hospitalized", "PATIENT_TYPE == 2")],
+]
+
+
+def build_hit_grid(targets):
+    """Buckets (button rectangle, value) click targets by every grid cell their rectangle overlaps."""
+    grid = {}
+    for rect, value in targets:
+        x1, y1 = rect.getP1().getX(), rect.getP1().getY()
+        x2, y2 = rect.getP2().getX(), rect.getP2().getY()
+        for cell_x in range(int(x1 // HIT_CELL_SIZE), int(x2 // HIT_CELL_SIZE) + 1):
+            for cell_y in range(int(y1 // HIT_CELL_SIZE), int(y2 // HIT_CELL_SIZE) + 1):
+                grid.setdefault((cell_x, cell_y), []).append((rect, value))
+    return grid
+
+
+def hit_test(grid, click_point):
+    """Returns the value of the button under click_point, checking only the buttons of its grid cell."""
+    cell = (int(click_point.getX() // HIT_CELL_SIZE), int(click_point.getY() // HIT_CELL_SIZE))
+    for rect, value in grid.get(cell, ()):
+        if is_button_clicked(click_point, rect):
+            return value
+    return None
+
+
+def make_scene(win, name, elements, targets, var_buttons=(), filter_buttons=()):
+    """Tags the drawn elements of a page so it can be hidden and shown as a whole; starts hidden."""
+    tag = "scene:" + name.replace(" ", "_")
+    for element in elements:
+        win.addtag_withtag(tag, element.id)
+    scene = {"tag": tag, "hits": build_hit_grid(targets), "var_buttons": list(var_buttons),
+             "filter_buttons": list(filter_buttons), "chart": [], "chart_key": None, "date_range": None}
+    set_scene_visible(win, scene, False)
+    return scene
+
+
+def set_scene_visible(win, scene, visible):
+    """Hides or shows every item of a scene with a single canvas call."""
+    win.itemconfigure(scene["tag"], state="normal" if visible else "hidden")
+
+
+def clear_selection(var_buttons):
+    """Unselects the variable buttons of a scene, refilling only those that were selected."""
+    for var_data in var_buttons:
+        if var_data["selected"]:
+            var_data["selected"] = False
+            var_data["button"].setFill(UNSELECTED_FILL)
+
+
+def patient_filter_query(filter_buttons):
+    """The condition query of the selected patient filter buttons, or None when none is selected."""
+    clauses = []
+    for row in range(len(PATIENT_FILTERS)):
+        chosen = [filter_data["query"] for filter_data in filter_buttons
+                  if filter_data["row"] == row and filter_data["selected"]]
+        if chosen:
+            clauses.append(chosen[0] if len(chosen) == 1 else ("or", *chosen))
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else ("and", *clauses)
+
+
 
 # Define welcome page
 def welcome_page(win):
@@ -104,7 +1323,7 @@ def dataset_description_page(win):
     return continue_button, elements
 
 # Define home page
-def home_page(win):
+def home_page(win, patient_rows=True):
     """Displays the home page with graph type selection."""
     title = Text(Point(400, 80), "Select Desired Graph")
     title.setSize(20)
@@ -113,16 +1332,18 @@ def home_page(win):
 
     buttons = []
     elements = [title]  # Track all elements to undraw later
-    button_texts = ["Histogram", "Pie Chart", "Bar Plot", "Dataset Description"]
+    button_texts = ["Histogram", "Time Series", "Pie Chart", "Bar Plot", "Dataset Description"]
+    if not patient_rows:
+        button_texts.remove("Time Series")
     for i, text in enumerate(button_texts):
-        button, label = create_button(win, 240, 160 + i * 140, 560, 240 + i * 140, text)
+        button, label = create_button(win, 240, 160 + i * 120, 560, 240 + i * 120, text)
         buttons.append((button, text))  # Store button rectangle and its label text
         elements.extend([button, label])
     return buttons, elements
 
 
-def variable_selection_page(win, variables, selected_graph_type):
-    """Displays the variable selection page."""
+def variable_selection_page(win, variables, selected_graph_type, patient_rows=True):
+    """Displays the variable selection page, with the patient filters when the patient rows are kept."""
     title = Text(Point(400, 40), "Filters")
     title.setSize(20)
     title.draw(win)
@@ -130,7 +1351,7 @@ def variable_selection_page(win, variables, selected_graph_type):
     elements = [title]
 
     # Add the variable selection text based on chart type
-    if selected_graph_type == "histogram":
+    if selected_graph_type in ["histogram", "time series"]:
         select_var_text = Text(Point(400, 83), "Select one, or multiple, variables to analyze")
     else:  # barplot or pie chart
         select_var_text = Text(Point(400, 83), "Select one variable to analyze")
@@ -147,13 +1368,36 @@ def variable_selection_page(win, variables, selected_graph_type):
         var_buttons.append({"button": button, "variable": var, "selected": False})
         elements.extend([button, label])
 
+    # Patient filter buttons
+    y_confirm = y_start + len(variables) * 80 + 40
+    filter_buttons = []
+    if patient_rows:
+        filter_buttons, filter_elements = patient_filter_controls(win, y_start + len(variables) * 80)
+        elements += filter_elements
+        y_confirm += 30 + len(PATIENT_FILTERS) * 50
+
     # Confirm button
-    confirm_button, confirm_label = create_button(win, 320, y_start + len(variables) * 80 + 40, 480,
-                                                  y_start + len(variables) * 80 + 104, "Confirm", "#fdbd22")
+    confirm_button, confirm_label = create_button(win, 320, y_confirm, 480, y_confirm + 64, "Confirm", "#fdbd22")
     elements.append(confirm_button)
     elements.append(confirm_label)
 
-    return var_buttons, confirm_button, elements
+    return var_buttons, filter_buttons, confirm_button, elements
+
+
+def patient_filter_controls(win, y_start):
+    """Draws a line of buttons per row of PATIENT_FILTERS, under a caption at y_start."""
+    caption = Text(Point(400, y_start + 10), "Only include patients who are (optional):")
+    caption.setSize(14)
+    caption.draw(win)
+    elements = [caption]
+    filter_buttons = []
+    for row, groups in enumerate(PATIENT_FILTERS):
+        y1 = y_start + 30 + row * 50
+        for i, (text, query) in enumerate(groups):
+            button, label = create_button(win, 240 + i * 165, y1, 395 + i * 165, y1 + 40, text)
+            filter_buttons.append({"button": button, "query": parse_query(query), "row": row, "selected": False})
+            elements.extend([button, label])
+    return filter_buttons, elements
 
 # Define graph display page
 def graph_display_page(win, graph_type, selected_variables):
@@ -171,38 +1415,172 @@ def graph_display_page(win, graph_type, selected_variables):
 
     return elements, back_to_variables_button, back_to_home_button
 
-def generate_bar_plot(win, dataset, selected_characteristic, elements):
-    """Generates a bar plot for patients with the selected characteristic by age groups."""
-
-    # Define age groups
-    infants_and_children = dataset[dataset['AGE'] <= 12]  # (0-12)
-    adolescents_and_young_adults = dataset[(dataset['AGE'] > 12) & (dataset['AGE'] <= 24)]  # (13-24)
-    adults = dataset[(dataset['AGE'] > 24) & (dataset['AGE'] <= 64)]  # (25-64)
-    older_adults = dataset[(dataset['AGE'] > 64) & (dataset['AGE'] <= 74)]  # (65-74)
-    elderly = dataset[dataset['AGE'] > 74]  # 75+
-
-    # Add age groups to a dictionary
-    age_groups = {
-        "Children": infants_and_children,
-        "Young Adults": adolescents_and_young_adults,
-        "Adults": adults,
-        "Older Adults": older_adults,
-        "Elderly": elderly
-    }
 
-    # Get total counts and deaths for each age group
-    totals = []
-    deaths = []
-    proportions = []
+def histogram_filter_controls(win, variables):
+    """Draws the filter buttons and Confirm button shown under the histogram."""
+    elements = []
+    variable_buttons = []
+    for i, var in enumerate(variables):
+        button, label = create_button(win, 60 + i * (160 + 20), 580, 230 + i * (160 + 20), 620, var)
+        variable_buttons.append({"button": button, "variable": var, "selected": False})
+        elements.extend([button, label])
+
+    confirm_button, confirm_label = create_button(win, 320, 640, 480, 680, "Confirm", "#fdbd22")
+    elements.extend([confirm_button, confirm_label])
+    return variable_buttons, confirm_button, elements
 
-    for age_group, group_data in age_groups.items():
-        has_characteristic = group_data[group_data[selected_characteristic] == 1]  # 1 == has the characteristic
-        total = len(has_characteristic)  # Total count with the characteristic
-        died = has_characteristic['DATE_DIED'].notnull().sum()  # Count of deaths
-        survived = total - died  # Count of survivors
 
-        totals.append(total)
-        deaths.append(died)
+def date_range_controls(win):
+    """Draws the buttons that move and zoom the date range of the time series, beside its Confirm button."""
+    elements = []
+    targets = []
+    for x1, text, action in [(40, "Earlier", "earlier"), (180, "Later", "later"),
+                             (490, "Zoom In", "zoom_in"), (630, "Zoom Out", "zoom_out")]:
+        button, label = create_button(win, x1, 640, x1 + 130, 680, text)
+        targets.append((button, action))
+        elements.extend([button, label])
+    return targets, elements
+
+
+def build_scenes(win, variables):
+    """Draws every page once as a hidden scene, keyed like main()'s pages."""
+    scenes = {}
+    continue_button, elements = welcome_page(win)
+    scenes["welcome"] = make_scene(win, "welcome", elements, [(continue_button, "continue")])
+
+    continue_button, elements = dataset_description_page(win)
+    scenes["dataset_description"] = make_scene(win, "dataset_description", elements,
+                                               [(continue_button, "continue")])
+
+    patient_rows = keeps_patient_rows()
+    buttons, elements = home_page(win, patient_rows)
+    scenes["home"] = make_scene(win, "home", elements, buttons)
+
+    for graph_type in ["histogram", "time series", "pie chart", "bar plot"]:
+        var_buttons, filter_buttons, confirm_button, elements = variable_selection_page(win, variables, graph_type,
+                                                                                        patient_rows)
+        targets = [(var_data["button"], var_data) for var_data in var_buttons + filter_buttons]
+        targets.append((confirm_button, "confirm"))
+        scenes["variable_selection", graph_type] = make_scene(win, f"variable_selection {graph_type}", elements,
+                                                              targets, var_buttons, filter_buttons)
+
+        elements, back_to_variables_button, back_to_home_button = graph_display_page(win, graph_type, [])
+        targets = [(back_to_variables_button, "back_to_variables"), (back_to_home_button, "back_to_home")]
+        var_buttons = []
+        if graph_type in ["histogram", "time series"]:
+            var_buttons, confirm_button, filter_elements = histogram_filter_controls(win, variables)
+            elements += filter_elements
+            targets += [(var_data["button"], var_data) for var_data in var_buttons] + [(confirm_button, "confirm")]
+        if graph_type == "time series":
+            range_targets, range_elements = date_range_controls(win)
+            elements += range_elements
+            targets += range_targets
+        scenes["graph_display", graph_type] = make_scene(win, f"graph_display {graph_type}", elements,
+                                                         targets, var_buttons)
+    return scenes
+
+
+def show_chart(win, scene, graph_type, selected_variables, where=None):
+    """Puts the chart for selected_variables in a graph display scene, replacing only its image.
+
+    The condition query where, if given, limits the chart to the patients matching it.
+    """
+    dataset = get_dataset()
+    chart_key = (tuple(selected_variables), dataset_version(dataset), scene["date_range"], where)
+    if scene["chart_key"] == chart_key:
+        return  # Still showing this chart from the last visit
+    undraw_elements(scene["chart"])
+    scene["chart"].clear()
+    if graph_type == "histogram":
+        generate_histogram(win, dataset, selected_variables, scene["chart"], where=where)
+    elif graph_type == "time series":
+        generate_time_series(win, dataset, selected_variables, scene["chart"], scene["date_range"], where=where)
+    elif graph_type == "pie chart":
+        generate_pie_chart(win, dataset, selected_variables[0], scene["chart"], where=where)
+    else:
+        generate_bar_plot(win, dataset, selected_variables[0], scene["chart"], where=where)
+    for element in scene["chart"]:
+        win.addtag_withtag(scene["tag"], element.id)
+        win.tag_lower(element.id)  # Keep buttons drawn over the chart
+    scene["chart_key"] = chart_key
+
+
+def refresh_chart(win, scene, graph_type):
+    """Redraws the chart of a scene if the dataset changed since it was drawn, keeping its selection."""
+    if scene["chart_key"] is not None:
+        selected_variables, _, _, where = scene["chart_key"]
+        show_chart(win, scene, graph_type, list(selected_variables), where)
+
+
+def move_date_range(scene, action):
+    """Pans or zooms the date range of the time series scene by one button press."""
+    extent = run_query(get_dataset(), "extent")
+    extent = extent["first_day"], extent["last_day"]
+    date_range = scene["date_range"] or extent
+    if action == "earlier":
+        scene["date_range"] = pan_date_range(date_range, extent, -1)
+    elif action == "later":
+        scene["date_range"] = pan_date_range(date_range, extent, 1)
+    elif action == "zoom_in":
+        scene["date_range"] = zoom_date_range(date_range, extent, 0.5)
+    else:
+        scene["date_range"] = zoom_date_range(date_range, extent, 2)
+    if scene["date_range"] == extent:
+        scene["date_range"] = None  # Fully zoomed out: follow the dates of appended rows too
+
+
+def wait_for_click(win, on_append=None):
+    """Waits for a click like win.getMouse, folding in appended rows meanwhile when following the CSV.
+
+    on_append() is called after new rows arrive (for a query server client, at every check,
+    since only the server knows), so the page can refresh what it shows.
+    """
+    if not FOLLOW_APPENDS:
+        return win.getMouse()
+    win.checkMouse()  # Like getMouse, ignore clicks made before we started waiting
+    next_check = time.monotonic() + APPEND_POLL_SECONDS
+    while True:
+        click = win.checkMouse()
+        if click is not None:
+            return click
+        if time.monotonic() >= next_check:
+            # A query server client cannot tell whether rows arrived, so it lets the page check its chart
+            if (CONNECT_URL is not None or ingest_appended_rows()) and on_append is not None:
+                on_append()
+            next_check = time.monotonic() + APPEND_POLL_SECONDS
+        time.sleep(0.05)
+
+
+def generate_bar_plot(win, dataset, selected_characteristic, elements, age_edges=None, export_path=None, where=None):
+    """Generates a bar plot for patients with the selected characteristic by age groups.
+
+    age_edges optionally replaces the default groups with custom upper (inclusive) ages,
+    export_path optionally saves the chart as a PNG file, and the condition query
+    where optionally limits it to the patients matching it.
+    """
+    with trace_phase("chart", graph_type="bar plot", selection=selected_characteristic):
+        png = bar_plot_png(dataset, selected_characteristic, age_edges, where)
+        show_png(win, png, (400, 350), elements, export_path)
+
+
+def bar_plot_png(dataset, selected_characteristic, age_edges=None, where=None):
+    """Returns the bar plot as PNG bytes, rendering it only if it is not cached."""
+    where = as_query(where)
+    key = ("bar plot", selected_characteristic, tuple(age_edges or AGE_GROUP_EDGES), where, dataset_version(dataset))
+    return cached_chart(key, lambda: render_bar_plot(dataset, selected_characteristic, age_edges, where))
+
+
+def render_bar_plot(dataset, selected_characteristic, age_edges=None, where=None):
+    """Renders the bar plot of generate_bar_plot to PNG bytes."""
+    import_pyplot()
+    where = as_query(where)
+    # Get survivors and deaths for each age group
+    counts = run_query(dataset, "bar", variable=selected_characteristic, age_edges=age_edges, where=where)
+    age_groups, survived_counts, died_counts = counts["age_groups"], counts["survived"], counts["died"]
+
+    proportions = []
+    for age_group, survived, died in zip(age_groups, survived_counts, died_counts):
+        total = survived + died  # Total count with the characteristic
         proportions.append({
             'Age Group': age_group,
             'Total': total,
@@ -212,15 +1590,41 @@ def generate_bar_plot(win, dataset, selected_characteristic, elements):
             'Died %': died / total * 100 if total > 0 else 0
         })
 
-    # Define labels and weights for the bar plot
     labels = [p['Age Group'] for p in proportions]
-    survived = [p['Survived'] for p in proportions]
-    died = [p['Died'] for p in proportions]
+    template = figure_template(("bar plot", tuple(labels)), lambda: bar_plot_template(labels))
+
+    # Stack the survivors on top of the deaths
+    for died_bar, survived_bar, p in zip(template["died"], template["survived"], proportions):
+        died_bar.set_height(p['Died'])
+        survived_bar.set_y(p['Died'])
+        survived_bar.set_height(p['Survived'])
+    template["axes"].relim()
+    template["axes"].autoscale_view()
+
+    template["title"].set_text(f"Patients with {selected_characteristic} by Combined Age Groups"
+                               + query_subtitle(where))
+
+    # Map long names to abbreviations for legend
+    name_mapping = {
+        "Young Adults": "YA",
+        "Older Adults": "OA",
+    }
+
+    # Proportions as a Secondary Legend
+    template["proportions"].set_text("Survived vs Died\n" + "\n".join([
+        f"{name_mapping.get(p['Age Group'], p['Age Group'])}: {p['Survived %']:.1f}% vs {p['Died %']:.1f}% "
+        for p in proportions
+    ]))
 
+    return figure_png(template["figure"], bbox_inches="tight")
+
+
+def bar_plot_template(labels):
+    """Draws the parts of the bar plot that stay the same for every variable, with empty bars per age group."""
     # Create the stacked bar plot
-    plt.figure(figsize=(7, 6), facecolor='white')  # Adjust figure size for better scaling
+    figure = plt.figure(figsize=(7, 6), facecolor='white')  # Adjust figure size for better scaling
     width = 0.5
-    bottom = np.zeros(len(labels))  # Initialize bottom values for stacking
+    empty = np.zeros(len(labels))
 
     # Assign Colors and Hatches to bars
     colors = {
@@ -233,16 +1637,16 @@ def generate_bar_plot(win, dataset, selected_characteristic, elements):
     }
 
     # Add bars for each category
-    for key, weight_count in zip(['Died', 'Survived'], [died, survived]):
-        plt.bar(labels, weight_count, width, label=key, bottom=bottom,
-                color=colors[key], hatch=hatches[key], edgecolor='black')
-        bottom += weight_count  # Update bottom for stacking
+    bars = {key: plt.bar(labels, empty, width, label=key, bottom=empty,
+                         color=colors[key], hatch=hatches[key], edgecolor='black')
+            for key in ['Died', 'Survived']}
 
     # Add title and labels
-    plt.title(f"Patients with {selected_characteristic} by Combined Age Groups", fontsize=14)
+    title = plt.title("", fontsize=14)
     plt.ylabel("Number of Patients", fontsize=12)
-    plt.xticks(rotation=45, fontsize=10)
-    plt.yticks(fontsize=10)
+    # Set on the axes rather than on today's tick labels, so ticks added by a later render match
+    plt.tick_params(axis='x', labelrotation=45, labelsize=10)
+    plt.tick_params(axis='y', labelsize=10)
 
     # Legend for Colors and Patterns
     color_pattern_legend = [
@@ -255,275 +1659,883 @@ def generate_bar_plot(win, dataset, selected_characteristic, elements):
     # Add the first legend to the plot
     plt.gca().add_artist(legend1)
 
-    # Map long names to abbreviations for legend
-    name_mapping = {
-        "Young Adults": "YA",
-        "Older Adults": "OA",
-    }
-
-    # Proportions as a Secondary Legend
-    proportion_text = "Survived vs Died\n" + "\n".join([
-        f"{name_mapping.get(p['Age Group'], p['Age Group'])}: {p['Survived %']:.1f}% vs {p['Died %']:.1f}% "
-        for p in proportions
-    ])
+    # Box for the survived vs died proportions
     props = dict(boxstyle="round,pad=0.3", edgecolor="black", facecolor="white")
-    plt.gca().text(1.02, 1, proportion_text, transform=plt.gca().transAxes, fontsize=10,
-                   verticalalignment='top', bbox=props)
+    proportions = plt.gca().text(1.02, 1, "", transform=plt.gca().transAxes, fontsize=10,
+                                 verticalalignment='top', bbox=props)
 
     # Adjust layout
     plt.subplots_adjust(right=0.8, top=0.9)  # Make space for legends
 
-    # Save and display the plot
-    plt.savefig("bar_plot_with_two_legends.png", bbox_inches="tight")
-    plt.close()
+    return {"figure": figure, "axes": plt.gca(), "died": bars['Died'], "survived": bars['Survived'],
+            "title": title, "proportions": proportions}
 
-    img = Image(Point(400, 350), "bar_plot_with_two_legends.png")
-    img.draw(win)
-    elements.append(img)
 
-def generate_histogram(win, dataset, filters, elements):
-    """Generates a histogram for the dataset and selected filters."""
+def generate_histogram(win, dataset, filters, elements, export_path=None, where=None):
+    """Generates a histogram for the dataset and selected filters, optionally saving it to export_path.
+
+    The condition query where optionally limits it to the patients matching it.
+    """
+    import_graphics()
     # Undraw any existing graph elements before drawing a new one
     graph_elements = [el for el in elements if isinstance(el, Image)]  # Find existing graph images
     undraw_elements(graph_elements)
     elements[:] = [el for el in elements if el not in graph_elements]  # Remove undrawn graph images from elements
 
-    # Filter and prepare the data
-    dataset = filter_dataset(dataset, filters)
+    with trace_phase("chart", graph_type="histogram", selection=list(filters)):
+        png = histogram_png(dataset, filters, where)
+        show_png(win, png, (400, 300), elements, export_path)
+
+
+def histogram_png(dataset, filters, where=None):
+    """Returns the histogram as PNG bytes, rendering it only if it is not cached."""
+    where = as_query(where)
+    key = ("histogram", tuple(filters), where, dataset_version(dataset))
+    return cached_chart(key, lambda: render_histogram(dataset, filters, where))
+
 
-    # Ensure DATE_DIED is a datetime column
-    dataset['DATE_DIED'] = pd.to_datetime(dataset['DATE_DIED'], errors='coerce')
+def render_histogram(dataset, filters, where=None):
+    """Renders the histogram of generate_histogram to PNG bytes."""
+    import_pyplot()
+    where = as_query(where)
+    # Deaths per month for the rows filter_dataset(dataset, filters) would keep
+    month_counts = np.asarray(run_query(dataset, "histogram", filters=filters, where=where)["months"])
+    template = figure_template(("histogram",), histogram_template)
 
-    # Extract the month from DATE_DIED
-    final = dataset['DATE_DIED'].dt.month
+    # The step outline runs along the top of bin after bin, two vertices per bin, then back along the bottom
+    outline = template["outline"].get_xy()
+    outline[1:2 * len(month_counts) + 1, 1] = np.repeat(month_counts, 2)
+    template["outline"].set_xy(outline)
+    for label, count in zip(template["labels"], month_counts):
+        label.set_y(count)
+        label.set_text(f'{int(count)}')
+    template["axes"].relim()
+    template["axes"].autoscale_view()
 
+    filters_text = ", ".join(filters) if filters else "No Filters"
+    template["title"].set_text(f'Histogram ({filters_text})' + query_subtitle(where))
+
+    return figure_png(template["figure"])
+
+
+def histogram_template():
+    """Draws the histogram with every month empty."""
     # Create the histogram
-    plt.figure(figsize=(7, 5), facecolor='white')
+    figure = plt.figure(figsize=(7, 5), facecolor='white')
     bins = np.arange(1, 14) - 0.5  # 12 bins for months
-    counts, edges, _ = plt.hist(final.dropna(), bins=bins, histtype='stepfilled', align='mid',
-                                edgecolor='black', color='#1e82c3', label='Deaths by Month')
+    counts, edges, patches = plt.hist(np.arange(1, 13), bins=bins, weights=np.zeros(12), histtype='stepfilled',
+                                      align='mid', edgecolor='black', color='#1e82c3', label='Deaths by Month')
+    labels = []
     for count, edge_left, edge_right in zip(counts, edges[:-1], edges[1:]):
         x = (edge_left + edge_right) / 2  # Midpoint of the bin
-        y = count
-        plt.text(x, y, f'{int(count)}', ha='center', va='bottom', fontsize=8)
+        labels.append(plt.text(x, count, '', ha='center', va='bottom', fontsize=8))
 
-    filters_text = ", ".join(filters) if filters else "No Filters"
-    plt.title(f'Histogram ({filters_text})')
+    title = plt.title('')
     plt.xlabel('Month')
     plt.ylabel('Number of Deaths')
     plt.xticks(ticks=np.arange(1, 13), labels=["J", "F", "M", "A", "M", "J", "J", "A", "S", "O", "N", "D"])
     plt.legend()
 
-    # Save and display the histogram
-    plt.savefig("histogram.png")
-    plt.close()
+    return {"figure": figure, "axes": plt.gca(), "outline": patches[0], "labels": labels, "title": title}
+
+
+def generate_time_series(win, dataset, filters, elements, date_range=None, export_path=None, where=None):
+    """Generates a chart of deaths per day or week over date_range (default: every recorded death date).
+
+    Ranges of up to DAILY_MAX_DAYS days are counted per day, longer ones per week.
+    The condition query where optionally limits it to the patients matching it.
+    """
+    with trace_phase("chart", graph_type="time series", selection=list(filters)):
+        png = time_series_png(dataset, filters, date_range, where)
+        show_png(win, png, (400, 300), elements, export_path)
+
+
+def time_series_png(dataset, filters, date_range=None, where=None):
+    """Returns the time series as PNG bytes, rendering it only if it is not cached."""
+    where = as_query(where)
+    if date_range is None:
+        extent = run_query(dataset, "extent")
+        date_range = extent["first_day"], extent["last_day"]
+    key = ("time series", tuple(filters), date_range, where, dataset_version(dataset))
+    return cached_chart(key, lambda: render_time_series(dataset, filters, date_range, where))
+
 
-    # Draw the new graph
-    img = Image(Point(400, 300), "histogram.png")
-    img.draw(win)
-    elements.append(img)  # Add the new graph image to the elements list
+def render_time_series(dataset, filters, date_range, where=None):
+    """Renders the time series of generate_time_series to PNG bytes."""
+    import_pyplot()
+    import matplotlib.dates as mdates
+
+    where = as_query(where)
+    first_day, last_day = date_range
+    series = run_query(dataset, "time-series", filters=filters, first_day=first_day, last_day=last_day,
+                       where=where)
+    bin_days, counts = series["bin_days"], np.asarray(series["counts"])
+    template = figure_template(("time series",), time_series_template)
+
+    bin_edges = np.datetime64(first_day, 'D') + np.arange(len(counts) + 1) * bin_days
+    template["steps"].set_data(counts, mdates.date2num(bin_edges))
+    first_date, last_date = np.datetime64(first_day, 'D'), np.datetime64(last_day, 'D')
+    template["axes"].set_xlim(mdates.date2num(first_date), mdates.date2num(last_date + 1))
+    template["axes"].relim()
+    template["axes"].autoscale_view(scalex=False)
+
+    period = "Day" if bin_days == 1 else "Week"
+    filters_text = ", ".join(filters) if filters else "No Filters"
+    template["title"].set_text(f'Time Series ({filters_text})\n{first_date} to {last_date}, {int(counts.sum())} deaths'
+                               + query_subtitle(where))
+    template["ylabel"].set_text(f'Number of Deaths per {period}')
+    template["legend"].get_texts()[0].set_text(f'Deaths per {period}')
+
+    if where is not None:
+        # A third title line only fits once the saved area grows around it
+        return figure_png(template["figure"], bbox_inches="tight")
+    return figure_png(template["figure"])
+
+
+def time_series_template():
+    """Draws the time series with no deaths; the date range and counts are filled in by render_time_series."""
+    figure = plt.figure(figsize=(7, 5), facecolor='white')
+    steps = plt.stairs([0], [0, 1], fill=True, color='#1e82c3', linewidth=0, label='Deaths per Day')
+    plt.gca().xaxis_date()
+
+    title = plt.title('')
+    ylabel = plt.ylabel('')
+    figure.autofmt_xdate()
+    legend = plt.legend()
+
+    return {"figure": figure, "axes": plt.gca(), "steps": steps, "title": title, "ylabel": ylabel,
+            "legend": legend}
 
 #generate Pie Chart
-def generate_pie_chart(win, dataset, variable, elements):
-    """Generates and displays two pie charts for a selected variable."""
-    # Ensure the variable has expected values (e.g., 1 and 2 for "Had it" and "Did not have it")
-    filtered_dataset = dataset[dataset[variable].isin([1, 2])]
+def generate_pie_chart(win, dataset, variable, elements, export_path=None, where=None):
+    """Generates and displays two pie charts for a selected variable, optionally saving them to export_path.
 
-    # Split into 'dead' and 'alive' groups
-    dead = filtered_dataset[filtered_dataset['DATE_DIED'].notna()]
-    alive = filtered_dataset[filtered_dataset['DATE_DIED'].isna()]
+    The condition query where optionally limits them to the patients matching it.
+    """
+    with trace_phase("chart", graph_type="pie chart", selection=variable):
+        png = pie_chart_png(dataset, variable, where)
+        show_png(win, png, (400, 350), elements, export_path)
 
-    # Count occurrences of the selected variable in each group
-    dead_counts = dead[variable].value_counts(sort=False)
-    alive_counts = alive[variable].value_counts(sort=False)
 
-    # Define labels for the pie chart
-    labels = {1: 'Had it', 2: 'Did not have it'}
-    dead_labels = [labels.get(i, f"Other ({i})") for i in dead_counts.index]
-    alive_labels = [labels.get(i, f"Other ({i})") for i in alive_counts.index]
+def pie_chart_png(dataset, variable, where=None):
+    """Returns the pie charts as PNG bytes, rendering them only if they are not cached."""
+    where = as_query(where)
+    key = ("pie chart", variable, where, dataset_version(dataset))
+    return cached_chart(key, lambda: render_pie_chart(dataset, variable, where))
+
+
+def render_pie_chart(dataset, variable, where=None):
+    """Renders the two pie charts of generate_pie_chart to PNG bytes."""
+    import_pyplot()
+    import pandas as pd
+
+    where = as_query(where)
+    # Count deaths and survivors that had (1) or did not have (2) the variable
+    counts = run_query(dataset, "pie", variable=variable, where=where)
+    dead_counts = pd.Series(counts["died"], index=counts["codes"])
+    alive_counts = pd.Series(counts["survived"], index=counts["codes"])
 
     # Ensure both groups have the same categories for consistency in pie charts
-    all_labels = sorted(set(dead_counts.index).union(set(alive_counts.index)))
+    all_labels = sorted(set(dead_counts.index[dead_counts > 0]).union(set(alive_counts.index[alive_counts > 0])))
+    all_labels = all_labels or [1, 2]  # A condition query matching nobody still gets both (empty) pies
     dead_counts = dead_counts.reindex(all_labels, fill_value=0)
     alive_counts = alive_counts.reindex(all_labels, fill_value=0)
+    template = figure_template(("pie chart", tuple(all_labels)), lambda: pie_chart_template(all_labels))
+
+    template["title"].set_text(f"Pie Chart for {variable}" + query_subtitle(where))
+    update_pie(template["died"], dead_counts.to_numpy(), pctdistance=1.18)
+    update_pie(template["survived"], alive_counts.to_numpy(), pctdistance=1.20)
+
+    # The percentage labels move with the wedges, so lay the figure out again from where plt.pie left it
+    template["figure"].subplots_adjust(**template["layout"])
+    template["figure"].tight_layout()
+    return figure_png(template["figure"])
+
+
+def pie_chart_template(all_labels):
+    """Draws the two pie charts with one equal wedge per category of all_labels."""
+    # Define labels for the pie chart
+    labels = {1: 'Had it', 2: 'Did not have it'}
     legend_labels = [labels.get(i, f"Other ({i})") for i in all_labels]
+    placeholder = np.ones(len(all_labels))
 
     # Create the pie chart
-    plt.figure(figsize=(7, 5))
-    plt.suptitle(f"Pie Chart for {variable}", fontsize=16)
+    figure = plt.figure(figsize=(7, 5))
+    title = plt.suptitle("", fontsize=16)
 
     # Dead Pie Chart
     plt.subplot(121)
-    patches_dead, _, _ = plt.pie(dead_counts, labels=['' for _ in dead_counts], autopct='%1.1f%%',
-                                 colors=["#1e82c3", "#ee423a"], hatch=['o', '+'], pctdistance=1.18)
+    died = plt.pie(placeholder, labels=['' for _ in placeholder], autopct='%1.1f%%',
+                   colors=["#1e82c3", "#ee423a"], hatch=['o', '+'], pctdistance=1.18)
+    died = tuple(died) + (plt.text(0, 0, "No patients", ha='center', va='center', visible=False),)
     plt.title('Died')
 
     # Alive Pie Chart
     plt.subplot(122)
-    patches_alive, _, _ = plt.pie(alive_counts, labels=['' for _ in alive_counts], autopct='%1.1f%%',
-                                  colors=["#1e82c3", "#ee423a"], hatch=['o', '+'], pctdistance=1.20)
+    survived = plt.pie(placeholder, labels=['' for _ in placeholder], autopct='%1.1f%%',
+                       colors=["#1e82c3", "#ee423a"], hatch=['o', '+'], pctdistance=1.20)
+    survived = tuple(survived) + (plt.text(0, 0, "No patients", ha='center', va='center', visible=False),)
     plt.title('Survived')
 
     # Add the legend with the custom patches
-    combined_patches = patches_dead[:len(legend_labels)]
+    combined_patches = died[0][:len(legend_labels)]
     plt.legend(combined_patches, legend_labels, title="Legend",
                loc="upper right", bbox_to_anchor=(0, -0.2), ncol=1)
 
-    # Save and display the chart
-    plt.tight_layout()
-    plt.savefig("pie_chart.png")
-    plt.close()
-
-    img = Image(Point(400, 350), "pie_chart.png")
-    img.draw(win)
-    elements.append(img)
+    layout = {name: getattr(figure.subplotpars, name)
+              for name in ["left", "bottom", "right", "top", "wspace", "hspace"]}
+    return {"figure": figure, "title": title, "died": died, "survived": survived, "layout": layout}
+
+
+def update_pie(pie, counts, pctdistance, labeldistance=1.1):
+    """Resizes the wedges of a pie drawn by plt.pie to counts, moving its labels the way plt.pie places them.
+
+    Without any patient to count, the pie is hidden behind its "No patients" text.
+    """
+    wedges, label_texts, pct_texts, no_patients = pie
+    empty = counts.sum() == 0
+    for artist in [*wedges, *label_texts, *pct_texts]:
+        artist.set_visible(not empty)
+    no_patients.set_visible(empty)
+    if empty:
+        return
+    fracs = counts / counts.sum()
+    theta1 = 0
+    for wedge, label, pct, frac in zip(wedges, label_texts, pct_texts, fracs):
+        wedge.set_theta1(360. * theta1)
+        wedge.set_theta2(360. * (theta1 + frac))
+        thetam = 2 * np.pi * 0.5 * (wedge.theta1 + wedge.theta2) / 360
+        label.set_position((labeldistance * np.cos(thetam), labeldistance * np.sin(thetam)))
+        label.set_horizontalalignment('left' if label.get_position()[0] > 0 else 'right')
+        pct.set_position((pctdistance * np.cos(thetam), pctdistance * np.sin(thetam)))
+        pct.set_text('%1.1f%%' % (100. * frac))
+        theta1 += frac
 
 
 def filter_deaths(dataset):
     """Filters the dataset to include only rows where a death is recorded."""
-    dataset['DATE_DIED'] = pd.to_datetime(dataset['DATE_DIED'], format='%d/%m/%Y', errors='coerce')
-    dataset = dataset[dataset['DATE_DIED'].notna()]
-    return dataset
+    return dataset[dataset['DIED']]
 
 
-def filter_dataset(dataset, selected_variables):
-    """Filters the dataset based on selected variables."""
+def build_condition_index(dataset):
+    """Groups the row numbers of the dataset by their CONDITIONS bitmask value."""
+    conditions = dataset['CONDITIONS'].to_numpy()
+    rows = np.argsort(conditions, kind='stable')
+    values, starts, counts = np.unique(conditions[rows], return_index=True, return_counts=True)
+    return {"values": values, "starts": starts, "counts": counts, "rows": rows}
+
+
+def required_bits(selected_variables):
+    """The CONDITIONS bits a row needs to pass filter_dataset(selected_variables)."""
+    required = 0
     for var in selected_variables:
-        dataset = dataset[dataset[var] != 2]
-    return dataset
+        required |= condition_bit(var)
+    return required
 
 
-def main():
-    variables = ["DIABETES", "RENAL_CHRONIC", "ASTHMA", "CARDIOVASCULAR"]
+def flags_query(variables):
+    """The condition query keeping the same rows as filter_dataset(variables)."""
+    return ("and",) + tuple(("!=", var, 2) for var in variables)
+
+
+def split_filters(dataset, filters):
+    """Splits filter variables into those with a CONDITIONS bit in the dataset and a condition query for the rest.
+
+    The query is None when every variable has its bit, as the chart variables always do.
+    """
+    packed = VARIABLES if isinstance(dataset, np.ndarray) else dataset.columns
+    unpacked = [var for var in filters if var in CONDITION_FLAGS and var not in packed]
+    return [var for var in filters if var not in unpacked], (flags_query(unpacked) if unpacked else None)
+
+
+def both_queries(where, other):
+    """A condition query matching both where and other, either of which may be None."""
+    where = as_query(where)
+    if where is None or other is None:
+        return other if where is None else where
+    return ("and", where, other)
+
+
+def matching_conditions(dataset, selected_variables):
+    """Returns the condition index and a mask of its bitmask values that pass every selected variable."""
+    index = derived(dataset, "condition_index", build_condition_index)
+    required = required_bits(selected_variables)
+    return index, (index["values"] & required) == required
+
+
+def count_filtered(dataset, selected_variables):
+    """Number of rows filter_dataset(dataset, selected_variables) would keep."""
+    if not selected_variables:
+        return len(dataset)
+    if split_filters(dataset, selected_variables)[1] is not None:
+        return int(np.count_nonzero(query_mask(dataset, flags_query(selected_variables))))
+    index, matches = matching_conditions(dataset, selected_variables)
+    return int(index["counts"][matches].sum())
+
+
+def filtered_rows(dataset, selected_variables):
+    """Positions, in dataset order, of the rows that are not coded 2 for any selected variable."""
+    index, matches = matching_conditions(dataset, selected_variables)
+    rows = [index["rows"][start:start + count]
+            for start, count in zip(index["starts"][matches], index["counts"][matches])]
+    return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.intp)
+
+
+def filter_dataset(dataset, selected_variables):
+    """Filters the dataset based on selected variables.
+
+    A condition query (see parse_query) can be given instead of the variables;
+    ["DIABETES", "ASTHMA"] keeps the same rows as "DIABETES != 2 and ASTHMA != 2".
+    """
+    if not selected_variables:
+        return dataset
+    if is_query(selected_variables):
+        return dataset.take(np.flatnonzero(query_mask(dataset, selected_variables)))
+    if split_filters(dataset, selected_variables)[1] is not None:
+        return filter_dataset(dataset, flags_query(selected_variables))
+    with trace_phase("filter_dataset", selection=list(selected_variables)):
+        if 'CONDITIONS' in dataset:
+            return dataset.take(filtered_rows(dataset, selected_variables))
+        # Without the bitmask column, still combine every variable into a single mask
+        keep = np.logical_and.reduce([dataset[var].to_numpy() != 2 for var in selected_variables])
+        return dataset[keep]
+
+
+# Condition queries: AND/OR/NOT expressions over any column, written like
+#   SEX == 1 and (AGE < 18 or AGE >= 65) and not DIABETES == 2
+# and parsed into nested tuples ("and", query, ...), ("or", query, ...), ("not", query) and (op, column, value)
+COMPARISONS = {"==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt,
+               ">=": operator.ge}
+QUERY_TOKEN = re.compile(r"\s*(-?\d+(?:\.\d+)?|==|!=|<=|>=|<|>|\(|\)|\w+)")
+MASK_CACHE_ENTRIES = 256  # Comparison bitsets kept per dataset, each one bit per patient
+QUERY_CUBE_ENTRIES = 64  # Aggregate cubes of condition queries kept per dataset
+
+
+def query_tokens(text):
+    """Splits query text into numbers, comparison operators, parentheses and words."""
+    text = text.strip()
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = QUERY_TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f"unexpected {text[position:]!r} in query")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def next_token(tokens):
+    """Takes the next token of a query being parsed (tokens are kept last-first)."""
+    if not tokens:
+        raise ValueError("query ends too early")
+    return tokens.pop()
+
+
+def parse_query(text):
+    """Parses query text such as "SEX == 1 and (AGE < 18 or AGE >= 65)" into nested tuples.
+
+    "not" binds tighter than "and", which binds tighter than "or".
+    """
+    tokens = query_tokens(text)[::-1]
+    query = parse_clauses(tokens, "or")
+    if tokens:
+        raise ValueError(f"unexpected {tokens[-1]!r} in query")
+    return query
+
+
+def parse_clauses(tokens, joiner):
+    """Parses clauses joined by "or" or "and"; the clauses of an "or" are "and"s."""
+    clauses = [parse_clauses(tokens, "and") if joiner == "or" else parse_clause(tokens)]
+    while tokens and tokens[-1].lower() == joiner:
+        tokens.pop()
+        clauses.append(parse_clauses(tokens, "and") if joiner == "or" else parse_clause(tokens))
+    return clauses[0] if len(clauses) == 1 else (joiner, *clauses)
+
+
+def parse_clause(tokens):
+    """Parses a "not", a parenthesized query or a comparison such as AGE >= 65."""
+    token = next_token(tokens)
+    if token.lower() == "not":
+        return ("not", parse_clause(tokens))
+    if token == "(":
+        query = parse_clauses(tokens, "or")
+        if next_token(tokens) != ")":
+            raise ValueError("missing ) in query")
+        return query
+    op, value = next_token(tokens), next_token(tokens)
+    if not token.isidentifier() or op not in COMPARISONS or not re.fullmatch(r"-?\d+(\.\d+)?", value):
+        raise ValueError(f"expected a comparison such as AGE >= 65, got {token} {op} {value}")
+    return (op, token, float(value) if "." in value else int(value))
+
+
+def format_query(query):
+    """Writes a parsed query back as text that parse_query turns into the same tuples."""
+    kind = query[0]
+    if kind in ("and", "or"):
+        return f" {kind} ".join(map(format_subquery, query[1:]))
+    if kind == "not":
+        return f"not {format_subquery(query[1])}"
+    op, column, value = query
+    return f"{column} {op} {value}"
+
+
+def format_subquery(query):
+    """Formats a query nested in another one, in parentheses when it is an "and" or an "or"."""
+    text = format_query(query)
+    return f"({text})" if query[0] in ("and", "or") else text
+
+
+def as_query(where):
+    """Parses query text, passing parsed queries through; None or blank text means no query."""
+    if isinstance(where, str):
+        return parse_query(where) if where.strip() else None
+    return where
+
+
+def is_query(selection):
+    """Whether a filter_dataset selection is a condition query rather than a list of variables."""
+    return isinstance(selection, str) or (isinstance(selection, tuple) and len(selection) > 0
+                                          and (selection[0] in ("and", "or", "not") or selection[0] in COMPARISONS))
+
+
+def load_query_column(dataset, column):
+    """Reads one of QUERY_COLUMNS for the rows of a dataset, from its cache or else from the CSV.
+
+    A column parsed from the CSV is added to the cache when the dataset is still the cached snapshot.
+    """
+    if column not in QUERY_COLUMNS:
+        raise ValueError(f"unknown column {column!r} in query")
+    source = derived(dataset, "source", lambda _: None)
+    if source is None:
+        raise ValueError(f"{column!r} can only be queried on a dataset loaded from its CSV")
+    cache_dir = cache_dir_for(source["csv_path"])
+    signature = source["signature"]
+    if signature is not None:
+        arrays = read_cache(cache_dir, signature, [column])
+        if arrays is not None:
+            return arrays[column]
+    with trace_phase("load query column", column=column):
+        parsed = read_csv_lines(source["csv_path"], source["end"], usecols=[column])
+        values = compact_column(parsed[column])
+    if signature is not None:
+        add_cache_column(cache_dir, signature, column, values)
+    return values
+
+
+def loaded_query_columns(dataset):
+    """The buffers of the QUERY_COLUMNS a query has loaded into a dataset so far, which appends extend."""
+    if isinstance(dataset, np.ndarray):
+        return {}  # A streamed dataset has no rows to query
+    return derived(dataset, "query_columns", lambda _: {})
+
+
+def query_column(dataset, column):
+    """The values of one of QUERY_COLUMNS for every row of a dataset, loaded the first time a query uses it.
+
+    Only queries on the same column wait for it to load; the shared _DERIVED_LOCK is not held meanwhile.
+    """
+    columns = loaded_query_columns(dataset)
+    with _DERIVED_LOCK:
+        loaded = column in columns
+        if not loaded:
+            loading = derived(dataset, "query_column_locks", lambda _: {}).setdefault(column, threading.Lock())
+    if not loaded:
+        with loading:
+            if column not in columns:
+                values = load_query_column(dataset, column)
+                with _DERIVED_LOCK:
+                    columns[column] = values
+    with _DERIVED_LOCK:
+        return columns[column][:len(dataset)]  # Appends grow the buffer ahead of the rows
+
+
+def comparison_matches(values, comparison):
+    """Boolean array of the values (a Series) matching one comparison.
+
+    Missing values never match a comparison (so they do match its "not").
+    """
+    op, _, value = comparison
+    return COMPARISONS[op](values, value).to_numpy(dtype=bool, na_value=False)
+
+
+def comparison_bits(dataset, comparison):
+    """The rows matching one comparison as packed bits, computed once and then shared by every query using it."""
+    def build():
+        import pandas as pd
+
+        column = comparison[1]
+        values = dataset[column] if column in dataset else pd.Series(query_column(dataset, column), copy=False)
+        return np.packbits(comparison_matches(values, comparison))
+    return derived_entry(dataset, "comparison_bits", comparison, build, MASK_CACHE_ENTRIES)
+
+
+def evaluate_query(frame, query):
+    """Boolean mask of the rows of a small frame matching a parsed query, without the cached bitsets."""
+    kind = query[0]
+    if kind == "and":
+        return np.logical_and.reduce([evaluate_query(frame, subquery) for subquery in query[1:]])
+    if kind == "or":
+        return np.logical_or.reduce([evaluate_query(frame, subquery) for subquery in query[1:]])
+    if kind == "not":
+        return ~evaluate_query(frame, query[1])
+    return comparison_matches(frame[query[1]], query)
+
+
+def append_bits(bits, length, matches):
+    """The packed bits of length rows followed by the matches of new rows, copying the whole bytes as they are."""
+    whole = length // 8
+    tail = np.unpackbits(bits[whole:], count=length - 8 * whole).view(bool)
+    return np.concatenate([bits[:whole], np.packbits(np.concatenate([tail, matches]))])
+
+
+def carry_query_structures(dataset, appended, new_rows):
+    """Extends the comparison bitsets and query cubes of dataset to appended, its rows followed by new_rows.
+
+    Only new_rows are compared and counted. Entries using a column new_rows lacks are left to be rebuilt.
+    """
+    with _DERIVED_LOCK:
+        bits = list(derived(dataset, "comparison_bits", lambda _: OrderedDict()).items())
+        cubes = list(derived(dataset, "query_cubes", lambda _: OrderedDict()).items())
+    carried_bits = OrderedDict()
+    for comparison, old_bits in bits:
+        column = comparison[1]
+        if column in new_rows:
+            matches = comparison_matches(new_rows[column], comparison)
+            carried_bits[comparison] = append_bits(old_bits, len(dataset), matches)
+    carried_cubes = OrderedDict()
+    for where, cube in cubes:
+        with contextlib.suppress(KeyError):
+            matches = evaluate_query(new_rows, where)
+            carried_cubes[where] = cube + build_aggregate_cube(new_rows.loc[matches, CUBE_COLUMNS])
+    seed_derived(appended, "comparison_bits", carried_bits)
+    seed_derived(appended, "query_cubes", carried_cubes)
+
+
+def query_bits(dataset, query):
+    """Combines the cached comparison bitsets of a parsed query, eight rows per byte operation."""
+    kind = query[0]
+    if kind == "and":
+        return functools.reduce(np.bitwise_and, [query_bits(dataset, subquery) for subquery in query[1:]])
+    if kind == "or":
+        return functools.reduce(np.bitwise_or, [query_bits(dataset, subquery) for subquery in query[1:]])
+    if kind == "not":
+        return np.invert(query_bits(dataset, query[1]))  # Also sets the padding bits, which query_mask drops
+    return comparison_bits(dataset, query)
+
+
+def query_mask(dataset, where):
+    """Boolean mask of the rows matching a condition query, given as text or parsed."""
+    where = as_query(where)
+    with trace_phase("query", query=format_query(where)):
+        return np.unpackbits(query_bits(dataset, where), count=len(dataset)).view(bool)
+
+
+# Death date index: the DEATH_DAY of every death, sorted, so any date range is found by binary search
+DAILY_MAX_DAYS = 120  # Longest date range the time series shows per day rather than per week
+MIN_RANGE_DAYS = 7  # Zooming in stops at this many days
+
+
+def build_death_index(dataset, first_row=0):
+    """Sorts the deaths with a parseable date by DEATH_DAY, keeping their row numbers and CONDITIONS."""
+    days = dataset['DEATH_DAY'].to_numpy()
+    rows = np.flatnonzero(days != NO_DEATH_DAY)
+    rows = rows[np.argsort(days[rows], kind='stable')]
+    return {"days": days[rows], "rows": rows + first_row, "conditions": dataset['CONDITIONS'].to_numpy()[rows]}
+
+
+def merge_death_index(index, new_index):
+    """Inserts the entries of new_index, built for rows appended to index's dataset, keeping the days sorted."""
+    # Inserting after equal days keeps every day's rows in dataset order
+    positions = np.searchsorted(index["days"], new_index["days"], side='right')
+    return {key: np.insert(index[key], positions, new_index[key]) for key in index}
+
+
+def get_death_index(dataset):
+    """Returns the death date index of a dataset, building it on first use."""
+    if isinstance(dataset, np.ndarray):
+        raise ValueError("death dates are only indexed for a loaded dataset, not a streamed one")
+    return derived(dataset, "death_index", build_death_index)
+
+
+def death_range(index, first_day, last_day):
+    """Slice of the death index covering first_day to last_day inclusive, found by binary search."""
+    start = np.searchsorted(index["days"], first_day, side='left')
+    stop = np.searchsorted(index["days"], last_day, side='right')
+    return slice(start, stop)
+
+
+def deaths_between(dataset, first_day, last_day):
+    """Rows of the patients who died from first_day to last_day (days since 1970-01-01), in date order."""
+    index = get_death_index(dataset)
+    return dataset.take(index["rows"][death_range(index, first_day, last_day)])
+
+
+def death_day_extent(dataset):
+    """First and last recorded death day, or today alone if nobody died."""
+    days = get_death_index(dataset)["days"]
+    if len(days) == 0:
+        today = int(np.datetime64('today', 'D').astype(np.int64))
+        return today, today
+    return int(days[0]), int(days[-1])
+
+
+def death_counts(dataset, filters, first_day, last_day, bin_days=1, where=None):
+    """Deaths per bin_days-day period from first_day to last_day among patients passing filter_dataset(filters).
+
+    A condition query where further limits the count to the patients matching it.
+    """
+    filters, unpacked = split_filters(dataset, filters)
+    index = get_death_index(dataset)
+    window = death_range(index, first_day, last_day)
+    days, rows = index["days"][window], index["rows"][window]
+    if filters:
+        required = required_bits(filters)
+        matches = (index["conditions"][window] & required) == required
+        days, rows = days[matches], rows[matches]
+    where = both_queries(where, unpacked)
+    if where is not None:
+        days = days[query_mask(dataset, where)[rows]]
+    return np.bincount((days - first_day) // bin_days, minlength=(last_day - first_day) // bin_days + 1)
+
+
+def clamp_date_range(first_day, span, extent):
+    """The date range of span days starting at first_day, shifted and shortened to fit inside extent."""
+    span = min(span, extent[1] - extent[0] + 1)
+    first_day = min(max(first_day, extent[0]), extent[1] - span + 1)
+    return first_day, first_day + span - 1
+
+
+def zoom_date_range(date_range, extent, factor):
+    """Scales a date range around its middle day by factor, within extent."""
+    first_day, last_day = date_range
+    span = max(MIN_RANGE_DAYS, round((last_day - first_day + 1) * factor))
+    return clamp_date_range((first_day + last_day) // 2 - span // 2, span, extent)
+
+
+def pan_date_range(date_range, extent, direction):
+    """Moves a date range half its length earlier (direction -1) or later (1), within extent."""
+    first_day, last_day = date_range
+    span = last_day - first_day + 1
+    return clamp_date_range(first_day + direction * (span // 2), span, extent)
+
+
+def warm_up(variables):
+    """Loads the dataset, builds the aggregates and renders the charts most likely to be opened first."""
+    dataset = get_dataset()
+    build_indexes(dataset)
+    histogram_png(dataset, [])
+    for var in variables:
+        bar_plot_png(dataset, var)
+        pie_chart_png(dataset, var)
+        histogram_png(dataset, [var])
+
+
+def start_warm_up(variables):
+    """Runs warm_up on a background thread so it overlaps with the welcome pages."""
+    worker = threading.Thread(target=warm_up, args=(variables,), name="warm-up", daemon=True)
+    worker.start()
+    return worker
+
+
+def chart_jobs(variables):
+    """Lists every chart of the batch export as (graph type, selection, file name)."""
+    jobs = []
+    for var in variables:
+        jobs.append(("bar plot", var, f"bar_plot_{var}.png"))
+        jobs.append(("pie chart", var, f"pie_chart_{var}.png"))
+    for size in range(len(variables) + 1):
+        for filters in itertools.combinations(variables, size):
+            jobs.append(("histogram", list(filters), f"histogram_{'_'.join(filters) or 'no_filters'}.png"))
+            if not STREAM:
+                jobs.append(("time series", list(filters), f"time_series_{'_'.join(filters) or 'no_filters'}.png"))
+    return jobs
+
+
+def export_chart(output_dir, job, where=None):
+    """Renders one chart job to output_dir and returns its file name and wall time."""
+    graph_type, selection, file_name = job
+    start = time.perf_counter()
+    chart_png = {"bar plot": bar_plot_png, "pie chart": pie_chart_png, "histogram": histogram_png,
+                 "time series": time_series_png}[graph_type]
+    export_png(chart_png(get_dataset(), selection, where=where), os.path.join(output_dir, file_name))
+    return file_name, time.perf_counter() - start
+
+
+def export_settings():
+    """The module settings run() may have changed, which export workers need too."""
+    return {"DATASET_PATH": DATASET_PATH, "CONNECT_URL": CONNECT_URL, "AGGREGATE_WORKERS": AGGREGATE_WORKERS,
+            "STREAM_WORKERS": STREAM_WORKERS}
+
+
+def apply_settings(settings):
+    """Installs export_settings() in an export worker."""
+    globals().update(settings)
+
+
+def batch_export(output_dir, variables=VARIABLES, workers=None, where=None):
+    """Renders every chart combination to output_dir on a process pool, printing the timings.
+
+    With a condition query where, every chart only counts the patients matching it.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = chart_jobs(variables)
+    start = time.perf_counter()
+    build_indexes(get_dataset())  # Loaded once here so forked workers inherit the dataset and its cube and index
+    # No GUI or warm-up thread runs in this mode, so forking is safe; where it is not available the
+    # workers start afresh, and get the settings here before loading the dataset from its cache
+    context = get_context("fork" if "fork" in get_all_start_methods() else None)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=apply_settings,
+                             initargs=(export_settings(),)) as pool:
+        for file_name, seconds in pool.map(export_chart, itertools.repeat(output_dir), jobs, itertools.repeat(where)):
+            print(f"{file_name:<60} {seconds:8.3f} s")
+    print(f"Rendered {len(jobs)} charts to {output_dir} in {time.perf_counter() - start:.3f} s")
+
 
-    win = GraphWin("Graph Interface", 800, 800)
+def main():
+    variables = VARIABLES
+    with trace_phase("open window"):
+        import_graphics()
+        # Without autoflush nothing is repainted until the next getMouse, so building the scenes never flickers
+        win = GraphWin("Graph Interface", 800, 800, autoflush=False)
+
+    # The dataset loads while the welcome pages are shown; charts the warm-up
+    # has not reached yet are simply rendered on demand
+    start_warm_up(variables)
+    with trace_phase("build scenes"):
+        scenes = build_scenes(win, variables)
     current_page = "welcome"
-    elements = []
+    scene = None
 
     while True:
+        # Swap the visible scene; pages are never rebuilt
+        with trace_phase("page", page=current_page):
+            if current_page in ["variable_selection", "graph_display"]:
+                next_scene = scenes[current_page, selected_graph_type]
+            else:
+                next_scene = scenes[current_page]
+            if scene is not None:
+                set_scene_visible(win, scene, False)
+            scene = next_scene
+            clear_selection(scene["var_buttons"])
+            clear_selection(scene["filter_buttons"])
+            if current_page == "graph_display":
+                show_chart(win, scene, selected_graph_type, selected_variables, where)
+            set_scene_visible(win, scene, True)
+
         if current_page == "welcome":
-            undraw_elements(elements)
-            continue_button, elements = welcome_page(win)
-            click = win.getMouse()
-            if is_button_clicked(click, continue_button):
+            if hit_test(scene["hits"], wait_for_click(win)) == "continue":
                 current_page = "dataset_description"
 
         elif current_page == "dataset_description":
-            undraw_elements(elements)
-            continue_button, elements = dataset_description_page(win)
-            click = win.getMouse()
-            if is_button_clicked(click, continue_button):
+            if hit_test(scene["hits"], wait_for_click(win)) == "continue":
                 current_page = "home"
 
         elif current_page == "home":
-            undraw_elements(elements)
-            buttons, elements = home_page(win)
-            click = win.getMouse()
-            for button, graph_type in buttons:
-                if is_button_clicked(click, button):
-                    if graph_type == "Dataset Description":
-                        current_page = "dataset_description"
-                    else:
-                        selected_graph_type = graph_type.lower()
-                        single_selection = selected_graph_type in ["pie chart", "bar plot"]
-                        current_page = "variable_selection"
-                    break
+            graph_type = hit_test(scene["hits"], wait_for_click(win))
+            if graph_type == "Dataset Description":
+                current_page = "dataset_description"
+            elif graph_type is not None:
+                selected_graph_type = graph_type.lower()
+                single_selection = selected_graph_type in ["pie chart", "bar plot"]
+                current_page = "variable_selection"
 
         elif current_page == "variable_selection":
-            undraw_elements(elements)
-            var_buttons, confirm_button, elements = variable_selection_page(win, variables, selected_graph_type)
-
             selected_variables = []
 
             while True:
-                click = win.getMouse()
+                target = hit_test(scene["hits"], wait_for_click(win))
+
+                # Patient filters are toggled on their own, whatever the chart type
+                if isinstance(target, dict) and "query" in target:
+                    target["selected"] = not target["selected"]
+                    target["button"].setFill(SELECTED_FILL if target["selected"] else UNSELECTED_FILL)
 
                 # Handle variable selection (single or multiple selection)
-                for var_data in var_buttons:
-                    if is_button_clicked(click, var_data["button"]):
-                        if single_selection:
-                            # If single selection is enabled, deselect others
-                            for other_var in var_buttons:
-                                if other_var != var_data:
-                                    other_var["selected"] = False
-                                    other_var["button"].setFill("#4e7997")
-                        var_data["selected"] = not var_data["selected"]
-                        var_data["button"].setFill("#aad4d8" if var_data["selected"] else "#4e7997")
-                        selected_variables = [v["variable"] for v in var_buttons if v["selected"]]
+                elif isinstance(target, dict):
+                    if single_selection:
+                        # If single selection is enabled, deselect others
+                        clear_selection([v for v in scene["var_buttons"] if v is not target])
+                    target["selected"] = not target["selected"]
+                    target["button"].setFill(SELECTED_FILL if target["selected"] else UNSELECTED_FILL)
+                    selected_variables = [v["variable"] for v in scene["var_buttons"] if v["selected"]]
 
                 # Confirm button
-                if is_button_clicked(click, confirm_button) and selected_variables:
+                elif target == "confirm" and selected_variables:
+                    where = patient_filter_query(scene["filter_buttons"])
                     current_page = "graph_display"
                     break
 
         elif current_page == "graph_display":
-            undraw_elements(elements)
-
-            # Load the graph display page
-            elements, back_to_variables_button, back_to_home_button = graph_display_page(win, selected_graph_type,
-                                                                                         selected_variables)
-
-            # Generate the selected graph and ensure it is added to the elements list
-            if selected_graph_type == "histogram":
-                generate_histogram(win, DATASET, selected_variables, elements)
-
-                variable_buttons = []
-                for i, var in enumerate(variables):
-                    button, label = create_button(win, 60 + i * (160 + 20), 580, 230 + i * (160 + 20), 620, var)
-                    variable_buttons.append({"button": button, "variable": var, "selected": False})
-                    elements.extend([button, label])
-
-                confirm_button, confirm_label = create_button(win, 320, 640, 480, 680, "Confirm", "#fdbd22")
-                elements.extend([confirm_button, confirm_label])
-
-                while True:
-                    click = win.getMouse()
-
-                    # Handle variable selection
-                    for var_data in variable_buttons:
-                        if is_button_clicked(click, var_data["button"]):
-                            var_data["selected"] = not var_data["selected"]
-                            var_data["button"].setFill("#aad4d8" if var_data["selected"] else "#4e7997")
-                            selected_variables = [v["variable"] for v in variable_buttons if v["selected"]]
-
-                    if is_button_clicked(click, confirm_button) and selected_variables:
-                        generate_histogram(win, DATASET, selected_variables, elements)
-
-                    if is_button_clicked(click, back_to_variables_button):
-                        current_page = "variable_selection"
-                        break
-
-                    elif is_button_clicked(click, back_to_home_button):
-                        current_page = "home"
-                        break
-
-            elif selected_graph_type == "pie chart":
-                generate_pie_chart(win, DATASET, selected_variables[0], elements)
-
-                while True:
-                    click = win.getMouse()
-
-                    if is_button_clicked(click, back_to_variables_button):
-                        current_page = "variable_selection"
-                        break
+            while True:
+                target = hit_test(scene["hits"], wait_for_click(
+                    win, lambda: refresh_chart(win, scene, selected_graph_type)))
 
-                    elif is_button_clicked(click, back_to_home_button):
-                        current_page = "home"
-                        break
+                # Handle histogram filter selection
+                if isinstance(target, dict):
+                    target["selected"] = not target["selected"]
+                    target["button"].setFill(SELECTED_FILL if target["selected"] else UNSELECTED_FILL)
+                    selected_variables = [v["variable"] for v in scene["var_buttons"] if v["selected"]]
 
-            elif selected_graph_type == "bar plot":
-                generate_bar_plot(win, DATASET, selected_variables[0], elements)
+                elif target == "confirm" and selected_variables:
+                    show_chart(win, scene, selected_graph_type, selected_variables, where)
 
-                while True:
-                    click = win.getMouse()
+                elif target in ["earlier", "later", "zoom_in", "zoom_out"] and scene["chart_key"] is not None:
+                    move_date_range(scene, target)
+                    refresh_chart(win, scene, selected_graph_type)
 
-                    if is_button_clicked(click, back_to_variables_button):
-                        current_page = "variable_selection"
-                        break
+                elif target == "back_to_variables":
+                    current_page = "variable_selection"
+                    break
 
-                    elif is_button_clicked(click, back_to_home_button):
-                        current_page = "home"
-                        break
+                elif target == "back_to_home":
+                    current_page = "home"
+                    break
 
 
-main()
\ No newline at end of file
+def run(argv=None):
+    """Command line entry point: the GUI by default, or one of the headless modes."""
+    global FOLLOW_APPENDS, AGGREGATE_WORKERS, STREAM_WORKERS, CONNECT_URL
+    parser = argparse.ArgumentParser(description="Covid Tracker")
+    parser.add_argument("--export", metavar="DIR",
+                        help="render every chart to DIR without opening a window, then exit")
+    parser.add_argument("--where", metavar="QUERY",
+                        help='only count the patients matching QUERY in the --export charts, '
+                             'e.g. "SEX == 1 and (AGE < 18 or AGE >= 65)"')
+    parser.add_argument("--workers", type=int,
+                        help="processes used by --export and to count large datasets (default: one per CPU, "
+                             "or one for COVID_TRACKER_STREAM)")
+    parser.add_argument("--follow", action="store_true",
+                        help="pick up rows appended to the CSV (with --connect, to the server's dataset) "
+                             "while the GUI is open and refresh the chart")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="load the dataset once and answer chart queries over HTTP on PORT for --connect clients")
+    parser.add_argument("--connect", metavar="URL",
+                        help="get the chart data from a --serve query server at URL instead of loading the dataset")
+    parser.add_argument("--memory-report", action="store_true",
+                        help="compare the memory of the CSV read with default dtypes to the compact dataset, then exit")
+    args = parser.parse_args(argv)
+    if args.where and not args.export:
+        parser.error("--where only applies to --export")
+    if args.where and STREAM:
+        parser.error("--where needs the patient rows, which COVID_TRACKER_STREAM does not keep")
+    try:
+        where = as_query(args.where)
+    except ValueError as error:
+        parser.error(f"--where: {error}")
+    FOLLOW_APPENDS = args.follow
+    AGGREGATE_WORKERS = args.workers or AGGREGATE_WORKERS
+    STREAM_WORKERS = args.workers or STREAM_WORKERS
+    CONNECT_URL = args.connect.rstrip("/") if args.connect else None
+    if args.memory_report:
+        memory_report()
+    elif args.export:
+        batch_export(args.export, workers=args.workers, where=where)
+    elif args.serve is not None:
+        serve(args.serve)
+    else:
+        main()
+
+
+if __name__ == "__main__":
+    run()
\ No newline at end of file
@@ -0,0 +1,249 @@
+"""Times the Covid Tracker data pipeline on synthetic datasets of several sizes.
+
+    python benchmark.py                      # 1M, 10M and 50M rows
+    python benchmark.py --sizes 200000 1M    # custom sizes
+
+Each size runs in a fresh process and reports the wall time of loading,
+filtering, compiling condition queries (the first time, which also loads the
+columns they use, and again with their comparison masks cached), aggregating
+(serially and on one process per CPU) and rendering, along with the most
+memory each phase allocated on top of what was already allocated when it
+started. The memory comes from a second run traced with tracemalloc, which
+would slow the timed run down; memory-mapped cache pages and worker processes
+are not counted. It then serves the dataset with the query server
+and reports the requests per second answered to several client processes at
+once. No window is opened.
+"""
+import argparse
+import http.client
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+import Final_Code
+
+COLUMNS = ["USMER", "MEDICAL_UNIT", "SEX", "PATIENT_TYPE", "DATE_DIED", "INTUBED", "PNEUMONIA", "AGE",
+           "PREGNANT", "DIABETES", "COPD", "ASTHMA", "INMSUPR", "HIPERTENSION", "OTHER_DISEASE",
+           "CARDIOVASCULAR", "OBESITY", "RENAL_CHRONIC", "TOBACCO", "CLASIFFICATION_FINAL", "ICU"]
+
+# Share of patients coded 1 (has it) for each condition; the rest are 2 or a 97/98 unknown
+CONDITION_RATES = {"DIABETES": 0.12, "RENAL_CHRONIC": 0.02, "ASTHMA": 0.03, "CARDIOVASCULAR": 0.02,
+                   "COPD": 0.015, "INMSUPR": 0.013, "HIPERTENSION": 0.155, "OTHER_DISEASE": 0.027,
+                   "OBESITY": 0.15, "TOBACCO": 0.08, "PNEUMONIA": 0.13}
+UNKNOWN_RATE = 0.003
+DEATH_RATE = 0.07
+MISSING_AGE_RATE = 0.0005
+FIRST_DAY, LAST_DAY = np.datetime64('2020-01-01'), np.datetime64('2021-12-31')
+
+# Overlapping condition queries, so later ones reuse the comparison masks of earlier ones
+CONDITION_QUERIES = ["SEX == 1", "SEX == 1 and AGE >= 65", "SEX == 1 and (AGE < 18 or AGE >= 65)",
+                     "PATIENT_TYPE == 2 and not ICU == 2",
+                     "(SEX == 2 or PATIENT_TYPE == 2) and AGE >= 65 and DIABETES == 1",
+                     "OBESITY == 1 and not (HIPERTENSION == 2 or AGE < 18)"]
+
+
+def parse_size(text):
+    """Parses row counts such as 500000, 1M or 2.5M."""
+    text = text.strip().upper()
+    if text.endswith("M"):
+        return int(float(text[:-1]) * 1_000_000)
+    if text.endswith("K"):
+        return int(float(text[:-1]) * 1_000)
+    return int(text)
+
+
+def condition_codes(rng, rows, rate):
+    """Draws 1/2/97/98 codes with the given share of 1s."""
+    return rng.choice(np.array([1, 2, 97, 98], dtype=np.int8), size=rows,
+                      p=[rate, 1 - rate - 2 * UNKNOWN_RATE, UNKNOWN_RATE, UNKNOWN_RATE])
+
+
+def synthetic_chunk(rng, rows):
+    """Generates rows with the schema and value coding of clean_covid_data.csv."""
+    import pandas as pd
+
+    sex = rng.integers(1, 3, rows, dtype=np.int8)
+    patient_type = rng.choice(np.array([1, 2], dtype=np.int8), size=rows, p=[0.8, 0.2])
+    hospitalized = patient_type == 2
+    data = {
+        "USMER": rng.integers(1, 3, rows, dtype=np.int8),
+        "MEDICAL_UNIT": rng.integers(1, 14, rows, dtype=np.int8),
+        "SEX": sex,
+        "PATIENT_TYPE": patient_type,
+        # Intubation and ICU only apply to hospitalized patients, pregnancy only to women (SEX 1)
+        "INTUBED": np.where(hospitalized, condition_codes(rng, rows, 0.15), 97),
+        "ICU": np.where(hospitalized, condition_codes(rng, rows, 0.08), 97),
+        "PREGNANT": np.where(sex == 1, condition_codes(rng, rows, 0.01), 97),
+        "CLASIFFICATION_FINAL": rng.integers(1, 8, rows, dtype=np.int8),
+    }
+    for var, rate in CONDITION_RATES.items():
+        data[var] = condition_codes(rng, rows, rate)
+
+    ages = np.clip(rng.normal(42, 17, rows), 0, 110).round()
+    ages[rng.random(rows) < MISSING_AGE_RATE] = np.nan
+    data["AGE"] = pd.array(ages, dtype="Int16")
+
+    # Older patients die more often; survivors have no DATE_DIED at all
+    died = rng.random(rows) < DEATH_RATE * np.where(np.nan_to_num(ages) >= 65, 3, 0.6)
+    days = FIRST_DAY + rng.integers(0, (LAST_DAY - FIRST_DAY).astype(int) + 1, rows)
+    dates = pd.Series(days).dt.strftime(Final_Code.DATE_DIED_FORMAT)
+    data["DATE_DIED"] = dates.where(died)
+    return pd.DataFrame(data)[COLUMNS]
+
+
+def make_synthetic_csv(path, rows, seed=0, chunk_rows=1_000_000):
+    """Writes a synthetic dataset of the given size, chunk by chunk, to path."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="") as f:
+        for start in range(0, rows, chunk_rows):
+            chunk = synthetic_chunk(rng, min(chunk_rows, rows - start))
+            chunk.to_csv(f, index=False, header=start == 0)
+
+
+def measure(results, phase, function, *args):
+    """Runs function(*args), recording its wall time and, when tracing, the most memory it allocated under phase."""
+    traced = tracemalloc.is_tracing()
+    if traced:
+        tracemalloc.reset_peak()  # Otherwise every phase would report the highest peak of the ones before it
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - start
+    results.append((phase, seconds, tracemalloc.get_traced_memory()[1] - start_memory if traced else None))
+    return value
+
+
+def filter_all(dataset):
+    """Applies filter_dataset for every combination of the chart variables."""
+    for size in range(len(Final_Code.VARIABLES) + 1):
+        for filters in itertools.combinations(Final_Code.VARIABLES, size):
+            Final_Code.filter_dataset(dataset, list(filters))
+
+
+def query_all(dataset):
+    """Compiles every condition query to the mask of the rows it selects."""
+    for query in CONDITION_QUERIES:
+        Final_Code.query_mask(dataset, query)
+
+
+def render_all(dataset):
+    """Renders one of each chart type without going through the chart cache."""
+    variable = Final_Code.VARIABLES[0]
+    Final_Code.render_bar_plot(dataset, variable)
+    Final_Code.render_pie_chart(dataset, variable)
+    Final_Code.render_histogram(dataset, [variable])
+
+
+def query_paths():
+    """Request paths of every chart query the GUI can make with the default date range."""
+    paths = []
+    for var in Final_Code.VARIABLES:
+        paths.append(f"/bar?variable={var}")
+        paths.append(f"/pie?variable={var}")
+    for size in range(len(Final_Code.VARIABLES) + 1):
+        for filters in itertools.combinations(Final_Code.VARIABLES, size):
+            paths.append(f"/histogram?filters={','.join(filters)}")
+            paths.append(f"/time-series?filters={','.join(filters)}")
+    return paths
+
+
+def query_load(port, seconds, first_path):
+    """Sends chart queries over one kept-open connection for the given time; returns how many were answered."""
+    paths = query_paths()
+    connection = http.client.HTTPConnection(Final_Code.SERVE_HOST, port)
+    answered = 0
+    deadline = time.perf_counter() + seconds
+    for path in itertools.islice(itertools.cycle(paths), first_path, None):
+        if time.perf_counter() >= deadline:
+            break
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path} failed with HTTP {response.status}")
+        answered += 1
+    connection.close()
+    return answered
+
+
+def serve_dataset(clients, seconds):
+    """Serves the dataset on a free local port to client processes; returns the requests answered per second."""
+    Final_Code.build_indexes(Final_Code.get_dataset())  # As serve() does, so no request waits for the load
+    server = Final_Code.make_query_server(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    with ProcessPoolExecutor(max_workers=clients, mp_context=get_context("spawn")) as pool:
+        # Let every client process start up before the timing begins
+        list(pool.map(query_load, [port] * clients, [0] * clients, range(clients)))
+        start = time.perf_counter()
+        answered = sum(pool.map(query_load, [port] * clients, [seconds] * clients, range(clients)))
+        elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    return answered / elapsed
+
+
+def run_size(csv_path, clients=8, seconds=5.0, traced=False):
+    """Benchmarks every phase on one CSV; runs in its own process so nothing is loaded or cached yet."""
+    shutil.rmtree(Final_Code.cache_dir_for(csv_path), ignore_errors=True)
+    if traced:
+        tracemalloc.start()
+    results = []
+    measure(results, "load (parse CSV, write cache)", Final_Code.load_dataset, csv_path)
+    dataset = measure(results, "load (memory-mapped cache)", Final_Code.load_dataset, csv_path)
+    measure(results, "filter (16 filter_dataset calls)", filter_all, dataset)
+    measure(results, f"query ({len(CONDITION_QUERIES)} masks, first use)", query_all, dataset)
+    measure(results, f"query ({len(CONDITION_QUERIES)} again, cached)", query_all, dataset)
+    measure(results, "aggregate (build cube)", Final_Code.build_aggregate_cube, dataset)
+    measure(results, "aggregate (streamed CSV)", Final_Code.stream_aggregate_cube, csv_path)
+    workers = Final_Code.AGGREGATE_WORKERS
+    measure(results, f"aggregate ({workers}-way, CSV byte ranges)", Final_Code.parallel_aggregate_cube,
+            csv_path, workers, False)
+    measure(results, f"aggregate ({workers}-way, cache row ranges)", Final_Code.parallel_aggregate_cube, csv_path)
+    Final_Code.get_aggregate_cube(dataset)
+    Final_Code.import_pyplot()  # Keep the one-off matplotlib import out of the render timing
+    measure(results, "render (bar, pie, histogram)", render_all, dataset)
+    Final_Code.DATASET_PATH = csv_path  # What the query server loads
+    rate = measure(results, f"serve ({clients} clients)", serve_dataset, clients, seconds)
+    results[-1] = (f"serve ({clients} clients, {rate:,.0f} req/s)",) + results[-1][1:]
+    tracemalloc.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1M", "10M", "50M"], help="row counts to benchmark")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "covid_tracker_bench"),
+                        help="where the synthetic CSVs are generated and kept between runs")
+    parser.add_argument("--clients", type=int, default=8, help="client processes querying the server at once")
+    parser.add_argument("--serve-seconds", type=float, default=5.0, help="how long the clients query the server")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    for rows in map(parse_size, args.sizes):
+        csv_path = os.path.join(args.data_dir, f"synthetic_{rows}.csv")
+        if not os.path.exists(csv_path):
+            start = time.perf_counter()
+            make_synthetic_csv(csv_path, rows)
+            print(f"Generated {rows:,} rows in {time.perf_counter() - start:.1f} s")
+
+        runs = []
+        for traced in (False, True):
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                runs.append(pool.submit(run_size, csv_path, args.clients, args.serve_seconds, traced).result())
+
+        print(f"\n{rows:,} rows ({os.path.getsize(csv_path) / 1e6:,.0f} MB CSV)")
+        for (phase, seconds, _), (_, _, peak) in zip(*runs):
+            print(f"  {phase:<36} {seconds:9.3f} s  {peak / 1e6:9.1f} MB peak allocated")
+
+
+if __name__ == "__main__":
+    main()